@@ -0,0 +1,183 @@
+"""
+non-blocking, level-controlled logging for the emulators
+
+Log records are appended to a bounded in-memory ring and are formatted and
+written to the output stream by a background thread. Thus logging a message
+does not block the event loop on a (possibly slow) stdout/stderr pipe.
+
+Records are kept unformatted in the ring, the formatting is done by
+the flusher thread. If messages are produced faster than they can be written,
+the oldest records are dropped and the number of dropped records is reported.
+
+Protocol frame dumps are switched on and off independently of the log level,
+so that frames can be dumped without enabling DEBUG messages. Only the OFF
+level disables frame dumps as well.
+
+Following environment variables are used by Logger.from_env()
+and Logger.configure_from_env():
+
+  EMU_LOG_LEVEL   log level name, e.g. DEBUG, INFO, WARNING or ERROR
+  EMU_LOG_FRAMES  set to '1' to dump all protocol frames, '0' to disable
+"""
+import os
+import time
+import atexit
+from enum import IntEnum
+from collections import deque
+from threading import Thread, Lock
+from typing import TextIO
+
+RING_SIZE = 16 * 1024
+# seconds between flushes of the log ring
+FLUSH_INTERVAL = 0.1
+
+
+class Level(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+    # disables all logging
+    OFF = 100
+
+
+_PREFIXES = {
+    Level.DEBUG: "",
+    Level.INFO: "",
+    Level.WARNING: "WARNING: ",
+    Level.ERROR: "ERROR: ",
+}
+
+
+class Logger:
+    def __init__(
+        self,
+        stream: TextIO,
+        level: Level = Level.INFO,
+        frames: bool = True,
+        ring_size: int = RING_SIZE,
+    ):
+        self.level = level
+        # dump protocol frames?
+        self.frames = frames
+
+        self._stream = stream
+        self._ring = deque(maxlen=ring_size)
+        self._dropped = 0
+
+        self._flusher = None
+        self._flusher_lock = Lock()
+
+    @staticmethod
+    def from_env(
+        stream: TextIO, default_level: Level = Level.INFO, default_frames: bool = True
+    ) -> "Logger":
+        logger = Logger(stream)
+        logger.configure_from_env(default_level, default_frames)
+
+        return logger
+
+    def configure_from_env(
+        self, default_level: Level = Level.INFO, default_frames: bool = True
+    ):
+        """
+        set log level and frame dumps from the environment variables,
+        the defaults are used for the variables that are not set
+        """
+        name = os.environ.get("EMU_LOG_LEVEL")
+        if name is None:
+            level = default_level
+        elif (level := Level.__members__.get(name.upper())) is None:
+            valid = ", ".join(Level.__members__)
+            raise ValueError(f"invalid EMU_LOG_LEVEL '{name}', valid levels: {valid}")
+
+        frames = os.environ.get("EMU_LOG_FRAMES")
+
+        self.level = level
+        self.frames = default_frames if frames is None else frames != "0"
+
+    def _append(self, level: Level, msg: str, args: tuple):
+        if self._flusher is None:
+            self._start_flusher()
+
+        if len(self._ring) == self._ring.maxlen:
+            # the oldest record will be pushed out of the ring
+            self._dropped += 1
+
+        self._ring.append((level, msg, args))
+
+    def log(self, level: Level, msg: str, *args):
+        """
+        log a message, the message is %-formatted with args by the flusher thread
+        """
+        if level < self.level:
+            return
+
+        self._append(level, msg, args)
+
+    def debug(self, msg: str, *args):
+        self.log(Level.DEBUG, msg, *args)
+
+    def info(self, msg: str, *args):
+        self.log(Level.INFO, msg, *args)
+
+    def warning(self, msg: str, *args):
+        self.log(Level.WARNING, msg, *args)
+
+    def error(self, msg: str, *args):
+        self.log(Level.ERROR, msg, *args)
+
+    def frame(self, direction: str, data: bytes):
+        """
+        log a protocol frame, if frame dumps are enabled
+
+        Frames are logged regardless of the log level, unless the level is OFF.
+        """
+        if not self.frames or self.level == Level.OFF:
+            return
+
+        self._append(Level.DEBUG, "%s %r", (direction, data))
+
+    def _start_flusher(self):
+        with self._flusher_lock:
+            if self._flusher is not None:
+                # started by other thread
+                return
+
+            self._flusher = Thread(target=self._run_flusher, daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def _format_records(self):
+        while True:
+            try:
+                level, msg, args = self._ring.popleft()
+            except IndexError:
+                # ring is empty
+                return
+
+            if args:
+                msg = msg % args
+
+            yield f"{_PREFIXES[level]}{msg}\n"
+
+    def flush(self):
+        """
+        write out all log records currently in the ring
+        """
+        text = "".join(self._format_records())
+
+        if self._dropped > 0:
+            dropped, self._dropped = self._dropped, 0
+            text += f"WARNING: {dropped} log records dropped\n"
+
+        if text == "":
+            return
+
+        self._stream.write(text)
+        self._stream.flush()
@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
-from typing import Optional
+from typing import Optional, Callable
 import traceback
 import asyncio
 from sys import stderr
-from enum import Enum
-from asyncio import StreamReader, StreamWriter, Event, IncompleteReadError
+from asyncio import StreamReader, StreamWriter
 from .watchable_attrs import WatchableAttrsMixin
+from .emulog import Logger, Level
+from .emuclock import clock
+from .scheduler import Scheduler, Timer
+from .trajectory import (
+    Phase,
+    Position,
+    SampleTransfer,
+    TrajectoryRejected,
+    move_phases,
+)
 
 PUCKS_NUM = 29
 
@@ -26,28 +35,56 @@ POSITION = "position"
 SPEEDDOWN = "speeddown"
 CLEARMEMORY = "clearmemory"
 
-_logging_enabled = False
+# max number of bytes to pull from the socket in one read
+READ_CHUNK_SIZE = 64 * 1024
+# log connection's batching statistics every this many flushes
+STATS_REPORT_FLUSHES = 1000
 
+# seconds between checks if a trajectory phase can be finished,
+# e.g. if the dewar lid is open
+PHASE_POLL_INTERVAL = 0.1
 
-def log(msg: str):
-    if _logging_enabled:
-        stderr.write(f"{msg}\n")
+# by default only report errors, unless logging is enabled with create_emulator(),
+# EMU_LOG_LEVEL and EMU_LOG_FRAMES environment variables override the defaults
+log = Logger.from_env(stderr, Level.WARNING, default_frames=False)
 
 
-async def _read_command(connection_name: str, reader: StreamReader) -> str:
-    cmd = await reader.readuntil(b"\r")
-    log(f"{connection_name}> {cmd!r}")
+class _UnknownCommand(Exception):
+    pass
 
-    # chop off trailing \r and make a string
-    return cmd[:-1].decode()
 
+class _ConnectionStats:
+    """
+    keeps track of how well commands are batched on a connection
+    """
+
+    def __init__(self):
+        self.commands = 0
+        self.flushes = 0
+        self.max_commands_per_flush = 0
+
+    def add_flush(self, num_commands: int):
+        self.commands += num_commands
+        self.flushes += 1
+        self.max_commands_per_flush = max(self.max_commands_per_flush, num_commands)
 
-async def _write_reply(connection_name: str, writer: StreamWriter, reply: str):
-    data = (reply + "\r").encode()
-    writer.write(data)
-    await writer.drain()
+    @property
+    def commands_per_flush(self) -> float:
+        if self.flushes == 0:
+            return 0.0
+
+        return self.commands / self.flushes
+
+    def __str__(self):
+        return (
+            f"{self.commands} commands in {self.flushes} flushes, "
+            f"{self.commands_per_flush:.2f} commands per flush "
+            f"(max {self.max_commands_per_flush})"
+        )
 
-    log(f"{connection_name}< {data!r}")
+
+def _encode_reply(reply: str) -> bytes:
+    return (reply + "\r").encode()
 
 
 def _encode_list(lst):
@@ -65,16 +102,21 @@ def _encode(val):
         return _encode_list(val)
 
 
+def _encode_sample(sample: Optional[tuple[int, int]]) -> str:
+    """
+    encode (puck, sample) state fields, -1 stands for no sample
+    """
+    if sample is None:
+        return "-1,-1"
+
+    return f"{sample[0]},{sample[1]}"
+
+
 def _get_command_args(command_name: str, command: str) -> list:
     args_str = command[len(command_name) + 1 : -1]
     return args_str.split(",")
 
 
-class _Positions(Enum):
-    HOME = "HOME"
-    SOAK = "SOAK"
-
-
 class _Speed:
     # TODO: check with the real robot for supported speed ratios
     RATIOS = ["0.01", "1.0", "10.0", "50.0", "75.0", "100.0"]
@@ -113,32 +155,103 @@ class _Speed:
 
 
 class _RobotArm:
-    def __init__(self):
-        self._position = _Positions.HOME
+    def __init__(self, scheduler: Scheduler, on_change: Callable[[], None]):
+        self._scheduler = scheduler
+        # invoked when arm's position or speed changes
+        self._on_change = on_change
+        self._position = Position.HOME
         self.speed = _Speed()
+        # name of the running trajectory, None when idle
+        self.path_name: Optional[str] = None
+
+        # the rest of the running trajectory
+        self._phase: Optional[Phase] = None
+        self._phases: list[Phase] = []
+        # travel time left in the current phase, at full speed
+        self._travel_left = 0.0
+        # virtual time when travelling at current speed started
+        self._travel_started = 0.0
+        self._timer: Optional[Timer] = None
+
+    def move_to(self, new_position: Position):
+        self.run_trajectory(new_position.value.lower(), move_phases(new_position))
+
+    def run_trajectory(self, path_name: str, phases: list[Phase]):
+        assert not self.is_moving()
+        self.path_name = path_name
+        self._phases = list(phases)
+        self._start_next_phase()
+
+    def _start_next_phase(self):
+        if not self._phases:
+            log.info(f"{self.path_name}: finished at {self.get_position_name()}")
+            self.path_name = None
+            self._phase = None
+            self._timer = None
+            self._on_change()
+            return
+
+        phase = self._phase = self._phases.pop(0)
+        log.info(f"{self.path_name}: {phase.name}")
+        if phase.start is not None:
+            phase.start()
 
-    def move_to(self, new_position: _Positions):
-        assert self._position is not None
-        asyncio.create_task(self._run_trajectory(new_position))
+        if phase.position is not None:
+            # start moving to new position
+            self._position = None
+        self._on_change()
 
-    async def _run_trajectory(self, new_position: _Positions):
-        # start moving to new position
-        log(f"moving to {new_position.value}")
-        self._position = None
+        self._travel_left = phase.travel_time
+        self._travel()
 
+    def _travel(self):
         # emulate that it take some time to reach destination position,
         # scale travel time according to current speed ratio
-        travel_time = 0.5 / self.speed.decimal_ratio
-        await asyncio.sleep(travel_time)
+        self._travel_started = clock.monotonic()
+        self._timer = self._scheduler.call_later(
+            self._travel_left / self.speed.decimal_ratio, self._phase_travelled
+        )
+
+    def _phase_travelled(self):
+        self._travel_left = 0.0
+
+        phase = self._phase
+        if phase.ready is not None and not phase.ready():
+            self._timer = self._scheduler.call_later(
+                PHASE_POLL_INTERVAL, self._phase_travelled
+            )
+            return
+
+        if phase.done is not None:
+            phase.done()
+
+        if phase.position is not None:
+            # we have arrived at our new position
+            self._position = phase.position
+
+        self._start_next_phase()
 
-        # we have arrived at our new position
-        self._position = new_position
-        log(f"reached {new_position.value}")
+    def abort(self):
+        """
+        stop the running trajectory, if any,
+        the arm is left in undefined position, if it was moving
+        """
+        if not self.is_moving():
+            return
+
+        log.info(f"{self.path_name}: aborted")
+        self._timer.cancel()
+        self._timer = None
+        self._phase = None
+        self._phases = []
+        self._travel_left = 0.0
+        self.path_name = None
+        self._on_change()
 
     def is_moving(self) -> bool:
-        return self._position is None
+        return self.path_name is not None
 
-    def get_position(self) -> _Positions:
+    def get_position(self) -> Optional[Position]:
         return self._position
 
     def get_position_name(self) -> str:
@@ -148,58 +261,109 @@ class _RobotArm:
         return self._position.value
 
     def change_speed(self, increase_speed: bool):
+        travelling = self._travel_left > 0.0
+        if travelling:
+            # account for the part of the phase travelled at the old speed
+            elapsed = clock.monotonic() - self._travel_started
+            travelled = elapsed * self.speed.decimal_ratio
+            self._travel_left = max(self._travel_left - travelled, 0.0)
+            self._timer.cancel()
+
         if increase_speed:
             self.speed.increase()
         else:
             self.speed.decrease()
 
+        if travelling:
+            # travel the rest of the phase at the new speed
+            self._travel()
+
+        self._on_change()
+
 
 class _DewarLid:
     OPEN_POS = 10
     CLOSED_POS = 0
+    # seconds it takes to move the lid by one position
+    STEP_TIME = 0.6
 
-    def __init__(self):
+    def __init__(self, scheduler: Scheduler, on_change: Callable[[], None]):
+        self._scheduler = scheduler
+        # invoked when lid's position or movement state changes
+        self._on_change = on_change
         self._position = self.OPEN_POS
         self._target_position = None
-        self._target_position_set = Event()
-
-    def start(self):
-        asyncio.create_task(self._run())
+        self._timer: Optional[Timer] = None
 
     def is_moving(self) -> bool:
         return self._target_position is not None
 
-    async def _run(self):
-        async def move_lid():
-            while self._position != self._target_position:
-                step = 1 if self._position < self._target_position else -1
-                self._position += step
-                await asyncio.sleep(0.6)
+    def is_open(self) -> bool:
+        return self._position == self.OPEN_POS and not self.is_moving()
 
+    def _step(self):
+        if self._position == self._target_position:
             self._target_position = None
-            self._target_position_set.clear()
+            self._timer = None
+            self._on_change()
+            return
+
+        self._position += 1 if self._position < self._target_position else -1
+        self._on_change()
+        self._timer = self._scheduler.call_later(self.STEP_TIME, self._step)
 
-        while True:
-            await self._target_position_set.wait()
-            await move_lid()
+    def _move(self, target_position: int):
+        self._target_position = target_position
+        if self._timer is None:
+            # not moving yet, start now
+            self._step()
+        else:
+            self._on_change()
 
     def open(self):
-        self._target_position = self.OPEN_POS
-        self._target_position_set.set()
+        self._move(self.OPEN_POS)
 
     def close(self):
-        self._target_position = self.CLOSED_POS
-        self._target_position_set.set()
+        self._move(self.CLOSED_POS)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        self._target_position = None
+        self._on_change()
 
 
 class _IsaraMixin(WatchableAttrsMixin):
     """
     contains code shared by ISARA and ISARA2 emulation
+
+    The robot is polled continuously on the monitor port. The encoded monitor
+    replies are cached, tagged with the version of the robot state they were
+    built from. Any change of the reported state bumps the version, thus
+    an unchanged state is replied with the cached bytes.
     """
 
+    # attributes reported in the monitor replies
+    _STATE_ATTRIBUTES = [
+        "remote_mode",
+        "door_closed",
+        "power_on",
+        "dewar_pucks",
+        "_message",
+    ]
+
     def __init__(self, operate_port: int, monitor_port: int):
         super().__init__()
 
+        # bumped on each change of the robot state
+        self._state_version = 0
+        # monitor command -> (state version, encoded reply)
+        self._monitor_replies: dict[str, tuple[int, bytes]] = {}
+        for name in self._STATE_ATTRIBUTES:
+            self.watch_attribute(name, self._state_changed)
+
         # TCP ports to use
         self._operate_port = operate_port
         self._monitor_port = monitor_port
@@ -222,8 +386,13 @@ class _IsaraMixin(WatchableAttrsMixin):
         self.dewar_pucks[0] = True
         self.dewar_pucks[PUCKS_NUM - 1] = True
 
-        self._robot_arm = _RobotArm()
-        self._dewar_lid = _DewarLid()
+        # runs all the timed robot actions
+        self._scheduler = Scheduler(log)
+        self._robot_arm = _RobotArm(self._scheduler, self._state_changed)
+        self._dewar_lid = _DewarLid(self._scheduler, self._state_changed)
+
+    def _state_changed(self, *_):
+        self._state_version += 1
 
     #
     # public API for changing the state of the ISARA
@@ -291,17 +460,23 @@ class _IsaraMixin(WatchableAttrsMixin):
 
         return command
 
+    def _handle_abort_command(self) -> str:
+        self._robot_arm.abort()
+        self._dewar_lid.stop()
+
+        return "abort"
+
     def _handle_operate_command(self, command: str) -> str:
         if command == ON:
             return self._handle_on_command()
         if command == OFF:
             return self._handle_off_command()
         if command == ABORT:
-            return "abort"
+            return self._handle_abort_command()
         if command in [SPEEDUP, SPEEDDOWN]:
             return self._handle_speed_command(command)
 
-        assert False, f"unexpected command {command} on operate connection"
+        raise _UnknownCommand()
 
     def _handle_monitor_command(self, command: str) -> str:
         if command == STATE:
@@ -313,39 +488,98 @@ class _IsaraMixin(WatchableAttrsMixin):
         if command == MESSAGE:
             return self._handle_message_command()
 
-        assert False, f"unexpected command {command} on monitor connection"
+        raise _UnknownCommand()
 
-    async def _new_operate_connection(self, reader: StreamReader, writer: StreamWriter):
-        log("new operate connection")
-        try:
-            while True:
-                cmd = await _read_command("operate", reader)
-                reply = self._handle_operate_command(cmd)
+    def _get_monitor_reply(self, command: str) -> bytes:
+        """
+        get encoded reply to a monitor command,
+        rebuilt only if the robot state have changed since the last time
+        """
+        cached = self._monitor_replies.get(command)
+        if cached is not None and cached[0] == self._state_version:
+            return cached[1]
 
-                await _write_reply("operate", writer, reply)
-        except IncompleteReadError:
-            # connection closed, we are done here
-            return
-        except:  # noqa
-            print(traceback.format_exc())
+        reply = _encode_reply(self._handle_monitor_command(command))
+        self._monitor_replies[command] = (self._state_version, reply)
 
-    async def _new_monitor_connection(self, reader: StreamReader, writer: StreamWriter):
-        log("new monitor connection")
+        return reply
+
+    def _get_operate_reply(self, command: str) -> bytes:
+        return _encode_reply(self._handle_operate_command(command))
+
+    def _reply(
+        self, connection_name: str, command: bytes, handler: Callable[[str], bytes]
+    ) -> bytes:
+        if log.frames:
+            log.frame(f"{connection_name}>", command + b"\r")
+
+        cmd = command.decode()
         try:
-            while True:
-                cmd = await _read_command("monitor", reader)
-                reply = self._handle_monitor_command(cmd)
+            reply = handler(cmd)
+        except (_UnknownCommand, NotImplementedError):
+            log.warning(f"unexpected command '{cmd}' on {connection_name} connection")
+            reply = _encode_reply(f"Error - Unknown command: {cmd}")
+        except Exception as ex:
+            log.error(traceback.format_exc())
+            reply = _encode_reply(f"Error - {ex}")
+
+        if log.frames:
+            log.frame(f"{connection_name}<", reply)
+        return reply
+
+    async def _serve_connection(
+        self,
+        connection_name: str,
+        reader: StreamReader,
+        writer: StreamWriter,
+        handler: Callable[[str], bytes],
+    ):
+        log.info(f"new {connection_name} connection")
+        stats = _ConnectionStats()
+        # trailing incomplete command, if any
+        buffer = b""
 
-                await _write_reply("monitor", writer, reply)
-        except IncompleteReadError:
-            # connection closed, we are done here
-            return
-        except:  # noqa
+        try:
+            while (data := await reader.read(READ_CHUNK_SIZE)) != b"":
+                *commands, buffer = (buffer + data).split(b"\r")
+                if not commands:
+                    # no complete command received yet
+                    continue
+
+                #
+                # handle all the commands we have received in one go,
+                # and send all the replies in one write
+                #
+                replies = [
+                    self._reply(connection_name, cmd, handler) for cmd in commands
+                ]
+                writer.writelines(replies)
+                await writer.drain()
+
+                stats.add_flush(len(replies))
+                if stats.flushes % STATS_REPORT_FLUSHES == 0:
+                    log.info(f"{connection_name} connection: {stats}")
+        except ConnectionError as ex:
+            log.info(f"{connection_name} connection lost: {ex}")
+        except Exception:
             # unexpected exception
-            print(traceback.format_exc())
+            log.error(traceback.format_exc())
+        finally:
+            writer.close()
+            log.info(f"{connection_name} connection closed: {stats}")
+
+    async def _new_operate_connection(self, reader: StreamReader, writer: StreamWriter):
+        await self._serve_connection(
+            "operate", reader, writer, self._get_operate_reply
+        )
+
+    async def _new_monitor_connection(self, reader: StreamReader, writer: StreamWriter):
+        await self._serve_connection(
+            "monitor", reader, writer, self._get_monitor_reply
+        )
 
     async def start(self):
-        self._dewar_lid.start()
+        self._scheduler.start()
 
         op_srv = await asyncio.start_server(
             self._new_operate_connection, host="0.0.0.0", port=self._operate_port
@@ -395,16 +629,29 @@ class Isara2(_IsaraMixin):
     emulates ISARA2 robot, aka the yellow robot at MicroMAX
     """
 
+    def __init__(self, operate_port: int, monitor_port: int):
+        super().__init__(operate_port, monitor_port)
+
+        self._transfer = SampleTransfer(
+            self.dewar_pucks, self._dewar_lid.open, self._dewar_lid.is_open
+        )
+        self.watch_attribute("dewar_pucks", self._transfer.set_pucks)
+
     def _handle_state_command(self) -> str:
         power_on = _encode(self.power_on)
         remote_mode = _encode(self.remote_mode)
         position = self._robot_arm.get_position_name()
+        path_name = self._robot_arm.path_name or ""
         path_running = _encode(self._robot_arm.is_moving())
         speed_ratio = self._robot_arm.speed.ratio
+        jaw_a, jaw_b = [_encode_sample(s) for s in self._transfer.jaws]
+        diff = _encode_sample(self._transfer.diff)
 
         return (
-            f"state({power_on},{remote_mode},1,DoubleGripper,{position},,1,1,-1,-1,-1,-1,-1,"
-            f"-1,-1,-1,,{path_running},0,{speed_ratio},0,0,0.3865678,75.0,72.0,1,0,0,"
+            f"state({power_on},{remote_mode},1,DoubleGripper,{position},{path_name},"
+            "1,1,"
+            f"{jaw_a},{jaw_b},{diff},"
+            f"-1,-1,,{path_running},0,{speed_ratio},0,0,0.3865678,75.0,72.0,1,0,0,"
             f"{self._message},67108864,152.9,-390.8,"
             "-17.3,-180.0,0.0,89.1,-75.6,-18.8,93.6,0.0,105.3,-165.5,,1,,1,0,0,0,0,"
             "0,0,0,0,0,0,0,0,0,changetool|3|3|0|-2.441|0.068|392.37|0.0|0.0|-0.984)"
@@ -433,13 +680,24 @@ class Isara2(_IsaraMixin):
             "0,0)"
         )
 
-    def _handle_put_traj(self) -> str:
-        if self._robot_arm.get_position() != _Positions.SOAK:
-            return "Rejected - Trajectory must start at position: SOAK"
+    def _plan_transfer(self, name: str, args: list[str]) -> list[Phase]:
+        if name in ("get", "back", "dry"):
+            return getattr(self._transfer, name)()
+
+        # the arguments are tool, puck, sample, followed by unused ones
+        try:
+            puck, sample = int(args[1]), int(args[2])
+        except (IndexError, ValueError):
+            raise TrajectoryRejected(f"Rejected - Invalid {name} arguments")
+
+        if name == "put" and self._robot_arm.get_position() != Position.SOAK:
+            raise TrajectoryRejected(
+                "Rejected - Trajectory must start at position: SOAK"
+            )
 
-        return "put"
+        return getattr(self._transfer, name)(puck, sample)
 
-    def _handle_traj_command(self, name, *_) -> str:
+    def _handle_traj_command(self, name, *args) -> str:
         if not self.power_on:
             return "Robot power disabled"
 
@@ -450,18 +708,21 @@ class Isara2(_IsaraMixin):
             return "Disabled when lid is moving"
 
         if name == "soak":
-            self._robot_arm.move_to(_Positions.SOAK)
+            self._robot_arm.move_to(Position.SOAK)
             return "soak"
 
         if name == "home":
-            self._robot_arm.move_to(_Positions.HOME)
+            self._robot_arm.move_to(Position.HOME)
             return "home"
 
-        if name == "back":
-            return "back"
+        if name in ("put", "get", "getput", "pick", "back", "dry"):
+            try:
+                phases = self._plan_transfer(name, list(args))
+            except TrajectoryRejected as ex:
+                return str(ex)
 
-        if name == "put":
-            return self._handle_put_traj()
+            self._robot_arm.run_trajectory(name, phases)
+            return name
 
         raise NotImplementedError(f"running trajectory '{name}'")
 
@@ -510,8 +771,8 @@ class Isara2(_IsaraMixin):
 def create_emulator(
     model: str, operate_port: int, monitor_port: int, enable_logging=False
 ):
-    global _logging_enabled
-    _logging_enabled = enable_logging
+    if enable_logging:
+        log.configure_from_env(Level.INFO, default_frames=True)
 
     classes = {"ISARA": Isara, "ISARA2": Isara2}
     klass = classes[model]
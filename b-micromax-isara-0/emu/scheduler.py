@@ -0,0 +1,89 @@
+"""
+scheduler for the emulator's timed actions
+
+All the timed actions, e.g. lid steps or trajectory phases, are kept in
+a heap, ordered by their deadlines in the virtual clock time. One task runs
+the actions when their deadlines are reached, thus the number of event loop
+tasks does not depend on the number of scheduled actions.
+
+Scheduled actions can be cancelled. Cancelled actions are left in the heap,
+and are dropped when their deadline is reached.
+"""
+from typing import Callable, Optional
+import heapq
+import asyncio
+import itertools
+import traceback
+from .emuclock import clock
+from .emulog import Logger
+
+
+class Timer:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline: float, callback: Callable[[], None]):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    def __init__(self, log: Logger):
+        self._log = log
+        # (deadline, sequence number, timer), the sequence number keeps
+        # the actions with the same deadline in the scheduling order
+        self._timers: list[tuple[float, int, Timer]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> Timer:
+        """
+        run the callback after delay seconds of virtual time
+        """
+        timer = Timer(clock.monotonic() + delay, callback)
+        heapq.heappush(self._timers, (timer.deadline, next(self._sequence), timer))
+        if self._timers[0][2] is timer:
+            # new earliest deadline
+            self._wakeup.set()
+
+        return timer
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _run_expired(self):
+        now = clock.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+
+            try:
+                timer.callback()
+            except:  # noqa
+                self._log.error(traceback.format_exc())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            self._wakeup.clear()
+            self._run_expired()
+
+            # sleep until the earliest deadline, or until an earlier one is scheduled
+            handle = None
+            if self._timers:
+                delay = clock.real_seconds(self._timers[0][0] - clock.monotonic())
+                handle = loop.call_later(max(delay, 0.0), self._wakeup.set)
+
+            await self._wakeup.wait()
+            if handle is not None:
+                handle.cancel()
@@ -0,0 +1,240 @@
+"""
+ISARA2 sample transfer trajectories
+
+Tracks the samples in the dewar, in the gripper and on the goniometer,
+and plans the trajectories moving the samples between them.
+
+The dewar occupancy is a pucks x puck positions presence matrix. When a puck
+is detected in the dewar, all of it's positions are considered occupied.
+
+The gripper is the double gripper, with two jaws. Jaw A holds the samples
+taken from the dewar, jaw B holds the samples taken from the goniometer.
+
+A trajectory is a list of phases, e.g. opening the lid, moving to the dewar,
+to the goniometer and back home. The samples are moved at the end of each
+phase. Pucks and samples are numbered from 1, as in the ISARA protocol.
+"""
+from typing import Optional, Callable, NamedTuple
+from enum import Enum
+import numpy
+
+# number of sample positions in a puck
+PUCK_POSITIONS = 16
+
+# phase travel times at full speed, in seconds
+MOVE_TIME = 0.5
+DEWAR_TIME = 6.0
+GONIO_TIME = 4.0
+HOME_TIME = 3.0
+DRY_TIME = 10.0
+
+JAW_A = 0
+JAW_B = 1
+
+# (puck, sample)
+Sample = tuple[int, int]
+
+
+class Position(Enum):
+    HOME = "HOME"
+    SOAK = "SOAK"
+    DEWAR = "DEWAR"
+    GONIO = "GONIO"
+    DRY = "DRY"
+
+
+class Phase(NamedTuple):
+    name: str
+    # robot position at the end of the phase, None if the robot does not move
+    position: Optional[Position]
+    # phase duration at full speed, in seconds
+    travel_time: float
+    # invoked at the start of the phase
+    start: Optional[Callable[[], None]] = None
+    # the phase is not finished until this returns true
+    ready: Optional[Callable[[], bool]] = None
+    # invoked at the end of the phase
+    done: Optional[Callable[[], None]] = None
+
+
+class TrajectoryRejected(Exception):
+    pass
+
+
+def move_phases(position: Position) -> list[Phase]:
+    """
+    trajectory moving the robot to the position, without any samples transfer
+    """
+    return [Phase(position.value.lower(), position, MOVE_TIME)]
+
+
+class SampleTransfer:
+    def __init__(
+        self,
+        pucks: list[bool],
+        open_lid: Callable[[], None],
+        lid_is_open: Callable[[], bool],
+    ):
+        self._open_lid = open_lid
+        self._lid_is_open = lid_is_open
+
+        # the sample positions occupied in the dewar, as [puck, position]
+        self.dewar = numpy.zeros((len(pucks), PUCK_POSITIONS), dtype=bool)
+        self._pucks = numpy.zeros(len(pucks), dtype=bool)
+        self.set_pucks(pucks)
+
+        # samples held by the gripper jaws
+        self.jaws: list[Optional[Sample]] = [None, None]
+        # the sample mounted on the goniometer
+        self.diff: Optional[Sample] = None
+
+    def set_pucks(self, pucks: list[bool]):
+        """
+        update dewar occupancy according to the detected pucks
+        """
+        present = numpy.array(pucks, dtype=bool)
+        # newly detected pucks are full, removed pucks are gone with their samples
+        self.dewar[present & ~self._pucks] = True
+        self.dewar[~present] = False
+        self._pucks = present
+
+    def _check_sample(self, puck: int, sample: int) -> Sample:
+        if not (1 <= puck <= len(self._pucks) and 1 <= sample <= PUCK_POSITIONS):
+            raise TrajectoryRejected(f"Rejected - Invalid sample {puck}:{sample}")
+
+        return puck, sample
+
+    def _check_gonio_sample(self):
+        """
+        check that the sample on the goniometer can be taken into jaw B
+        """
+        if self.diff is None:
+            raise TrajectoryRejected("Rejected - No sample on the goniometer")
+
+        if self.jaws[JAW_B] is not None:
+            # e.g. left there by an aborted trajectory, must be put back first
+            raise TrajectoryRejected("Rejected - Gripper jaw B holds a sample")
+
+    def _in_dewar(self, sample: Sample) -> bool:
+        puck, pos = sample
+        return bool(self.dewar[puck - 1, pos - 1])
+
+    #
+    # phases, the sample bookkeeping happens at the end of each phase
+    #
+
+    def _lid_phase(self) -> Phase:
+        return Phase("lid", None, 0.0, start=self._open_lid, ready=self._lid_is_open)
+
+    def _take_from_dewar(self, sample: Sample) -> Phase:
+        def done():
+            puck, pos = sample
+            self.dewar[puck - 1, pos - 1] = False
+            self.jaws[JAW_A] = sample
+
+        return Phase("dewar", Position.DEWAR, DEWAR_TIME, done=done)
+
+    def _return_to_dewar(self, jaws: list[int]) -> Phase:
+        def done():
+            for jaw in jaws:
+                puck, pos = self.jaws[jaw]
+                self.dewar[puck - 1, pos - 1] = True
+                self.jaws[jaw] = None
+
+        return Phase("dewar", Position.DEWAR, DEWAR_TIME, done=done)
+
+    def _exchange_on_gonio(self, get: bool, put: bool) -> Phase:
+        def done():
+            if get:
+                self.jaws[JAW_B], self.diff = self.diff, None
+            if put:
+                self.diff, self.jaws[JAW_A] = self.jaws[JAW_A], None
+
+        return Phase("goniometer", Position.GONIO, GONIO_TIME, done=done)
+
+    def _home_phase(self) -> Phase:
+        return Phase("home", Position.HOME, HOME_TIME)
+
+    def _fetch_phases(self, sample: Sample) -> list[Phase]:
+        """
+        phases to get the sample into jaw A, unless it's already there
+        """
+        if self.jaws[JAW_A] == sample:
+            # the sample have been picked already
+            return []
+
+        if self.jaws[JAW_A] is not None:
+            raise TrajectoryRejected("Rejected - Gripper holds another sample")
+
+        if not self._in_dewar(sample):
+            puck, pos = sample
+            raise TrajectoryRejected(f"Rejected - No sample at {puck}:{pos}")
+
+        return [self._lid_phase(), self._take_from_dewar(sample)]
+
+    #
+    # trajectories
+    #
+
+    def put(self, puck: int, sample: int) -> list[Phase]:
+        sample = self._check_sample(puck, sample)
+        if self.diff is not None:
+            raise TrajectoryRejected("Rejected - Sample already on the goniometer")
+
+        return self._fetch_phases(sample) + [
+            self._exchange_on_gonio(get=False, put=True),
+            self._home_phase(),
+        ]
+
+    def get(self) -> list[Phase]:
+        self._check_gonio_sample()
+
+        return [
+            self._exchange_on_gonio(get=True, put=False),
+            self._lid_phase(),
+            self._return_to_dewar([JAW_B]),
+            self._home_phase(),
+        ]
+
+    def getput(self, puck: int, sample: int) -> list[Phase]:
+        sample = self._check_sample(puck, sample)
+        self._check_gonio_sample()
+
+        return self._fetch_phases(sample) + [
+            self._exchange_on_gonio(get=True, put=True),
+            self._lid_phase(),
+            self._return_to_dewar([JAW_B]),
+            self._home_phase(),
+        ]
+
+    def pick(self, puck: int, sample: int) -> list[Phase]:
+        """
+        get the sample into the gripper, and wait with it at the soak position
+        """
+        sample = self._check_sample(puck, sample)
+        if self.jaws[JAW_A] is not None:
+            raise TrajectoryRejected("Rejected - Gripper holds another sample")
+
+        return self._fetch_phases(sample) + [
+            Phase("soak", Position.SOAK, MOVE_TIME),
+        ]
+
+    def back(self) -> list[Phase]:
+        """
+        return the samples held by the gripper to the dewar
+        """
+        jaws = [jaw for jaw, sample in enumerate(self.jaws) if sample is not None]
+        if not jaws:
+            raise TrajectoryRejected("Rejected - No sample in the gripper")
+
+        return [
+            self._lid_phase(),
+            self._return_to_dewar(jaws),
+            self._home_phase(),
+        ]
+
+    def dry(self) -> list[Phase]:
+        return [
+            Phase("dry", Position.DRY, DRY_TIME),
+            self._home_phase(),
+        ]
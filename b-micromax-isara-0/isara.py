@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
-from typing import Callable, Any
+"""
+Emulate ISARA Sample Changer API
+
+Runs one emulated robot, or in fleet mode, a number of robots described by
+a fleet config file, see fleet.conf for an example. The fleet robots are served
+from one event loop, or sharded over a number of worker processes.
+"""
+from typing import Callable, Any, NamedTuple
+import sys
+import time
 import asyncio
+import multiprocessing
 from sys import stderr
 from argparse import ArgumentParser
+from configparser import ConfigParser, SectionProxy, Error as ConfigError
+from multiprocessing.process import BaseProcess
 from emu.isara import create_emulator
 from overlord.emulator import EmulatedDevice, UnknownCommand
 from overlord.server import listen
 
+MODELS = ["ISARA", "ISARA2"]
+
+# seconds between checks for dead fleet worker processes
+WORKER_CHECK_INTERVAL = 1.0
+
 
 def parse_args():
     parser = ArgumentParser(description="Emulate ISARA Sample Changer API")
@@ -30,10 +47,25 @@ def parse_args():
 
     parser.add_argument(
         "--model",
-        choices=["ISARA", "ISARA2"],
+        choices=MODELS,
         default="ISARA2",
     )
 
+    parser.add_argument(
+        "--fleet",
+        metavar="CONFIG",
+        help="run the robots described in the fleet config file, "
+        "instead of a single robot",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes to shard the fleet robots over",
+    )
+
     return parser.parse_args()
 
 
@@ -64,9 +96,145 @@ class _EmulatedIsara(EmulatedDevice):
                 raise UnknownCommand(command)
 
 
-async def _run():
-    args = parse_args()
+class _Robot(NamedTuple):
+    name: str
+    model: str
+    operate_port: int
+    monitor_port: int
+    overlord_port: int
+
+
+def _get_port(section: SectionProxy, option: str) -> int:
+    port = section.getint(option)
+    if port is None:
+        raise ValueError(f"[{section.name}]: missing {option}")
+
+    return port
+
+
+def _read_fleet_config(path: str) -> list[_Robot]:
+    """
+    read the fleet config file
+
+    Each section describes a group of robots of the same model, the robots
+    of a group use consecutive ports, starting with the configured ones.
+    """
+    config = ConfigParser()
+    try:
+        if not config.read(path):
+            raise ValueError("can't read fleet config")
+    except ConfigError as ex:
+        raise ValueError(f"invalid fleet config: {ex}")
+
+    robots = []
+    for group in config.sections():
+        section = config[group]
+        model = section.get("model", "ISARA2")
+        if model not in MODELS:
+            raise ValueError(f"[{group}]: unknown model '{model}'")
+
+        for n in range(section.getint("instances", 1)):
+            robots.append(
+                _Robot(
+                    f"{group}-{n}",
+                    model,
+                    _get_port(section, "operate_port") + n,
+                    _get_port(section, "monitor_port") + n,
+                    _get_port(section, "overlord_port") + n,
+                )
+            )
+
+    ports = [
+        port
+        for robot in robots
+        for port in (robot.operate_port, robot.monitor_port, robot.overlord_port)
+    ]
+    if len(set(ports)) != len(ports):
+        raise ValueError("port ranges of the robots overlap")
+
+    return robots
+
+
+async def _run_robots(robots: list[_Robot], enable_logging: bool):
+    servers = []
+    for robot in robots:
+        emulator = create_emulator(
+            robot.model, robot.operate_port, robot.monitor_port, enable_logging
+        )
+        servers += [
+            emulator.start(),
+            listen(robot.overlord_port, _EmulatedIsara(emulator)),
+        ]
+
+    await asyncio.gather(*servers)
 
+
+def _describe(robot: _Robot) -> str:
+    return (
+        f"{robot.name} {robot.model}: operate port {robot.operate_port}, "
+        f"monitor port {robot.monitor_port}, overlord port {robot.overlord_port}"
+    )
+
+
+def _run_worker(robots: list[_Robot]):
+    try:
+        # only errors are logged, as logging all the robots frames is too much
+        asyncio.run(_run_robots(robots, enable_logging=False))
+    except KeyboardInterrupt:
+        # just exit without any fuss
+        pass
+
+
+def _run_sharded(robots: list[_Robot], workers: int):
+    """
+    spread the robots evenly over worker processes,
+    and restart any worker process that dies
+    """
+    # use 'spawn', so that worker processes get a clean copy of the emulator modules
+    mp = multiprocessing.get_context("spawn")
+    workers = max(1, min(workers, len(robots)))
+    shards = [robots[n::workers] for n in range(workers)]
+    processes: list[BaseProcess] = [None] * len(shards)
+
+    def start_worker(shard: int):
+        process = mp.Process(target=_run_worker, args=(shards[shard],), daemon=True)
+        process.start()
+        processes[shard] = process
+
+    for shard in range(len(shards)):
+        start_worker(shard)
+
+    while True:
+        time.sleep(WORKER_CHECK_INTERVAL)
+        for shard, process in enumerate(processes):
+            if process.is_alive():
+                continue
+
+            names = ", ".join(robot.name for robot in shards[shard])
+            stderr.write(
+                f"worker {process.pid} serving {names} died "
+                f"with exit code {process.exitcode}, restarting\n"
+            )
+            start_worker(shard)
+
+
+def _run_fleet(config_path: str, workers: int):
+    try:
+        robots = _read_fleet_config(config_path)
+    except ValueError as ex:
+        sys.exit(f"error: {config_path}: {ex}")
+
+    stderr.write(f"emulating fleet of {len(robots)} robots\n")
+    for robot in robots:
+        stderr.write(f" {_describe(robot)}\n")
+
+    if workers > 1:
+        _run_sharded(robots, workers)
+    else:
+        _run_worker(robots)
+
+
+async def _run(args):
     stderr.write(
         f"emulating {args.model} API\n"
         f" overlord port: {args.overlord_port}\n"
@@ -84,11 +252,17 @@ async def _run():
 
 
 def main():
+    args = parse_args()
+
     try:
-        asyncio.run(_run())
+        if args.fleet is not None:
+            _run_fleet(args.fleet, args.workers)
+        else:
+            asyncio.run(_run(args))
     except KeyboardInterrupt:
         # just exit without any fuss
         pass
 
 
-main()
+if __name__ == "__main__":
+    main()
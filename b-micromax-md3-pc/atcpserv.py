@@ -1,16 +1,214 @@
+import time
 import asyncio
 from queue import Queue
 from threading import Thread
+from typing import Optional, Callable, Coroutine
+from asyncio import StreamReader, StreamWriter
+
+# sample period for frames per second statistics, in seconds
+RATE_PERIOD = 1.0
+# on shutdown, max seconds to wait for connections to finish, before cancelling them
+SHUTDOWN_TIMEOUT = 2.0
+
+
+def new_event_loop(use_fast_loop: bool = True) -> asyncio.AbstractEventLoop:
+    """
+    create new event loop, use uvloop implementation if it is installed
+    """
+    if use_fast_loop:
+        try:
+            import uvloop
+
+            return uvloop.new_event_loop()
+        except ImportError:
+            # uvloop not available, fall back to the default loop
+            pass
+
+    return asyncio.new_event_loop()
+
+
+def run_event_loop(main: Coroutine, use_fast_loop: bool = True):
+    """
+    like asyncio.run(), but uses uvloop if available
+    """
+    loop = new_event_loop(use_fast_loop)
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        # cancel any left-over tasks, the same way as asyncio.run() does
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class ServerStats:
+    def __init__(self):
+        self.open_connections = 0
+        self.total_connections = 0
+        self.rejected_connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+
+        # (time, number of frames) samples, for rate calculation
+        self._prev_sample = self._last_sample = (time.monotonic(), 0)
+
+    def _frames(self) -> int:
+        return self.frames_in + self.frames_out
+
+    @property
+    def frames_per_second(self) -> float:
+        """
+        frames per second, in and out, averaged over last sampling period
+        """
+        now = time.monotonic()
+        if now - self._last_sample[0] >= RATE_PERIOD:
+            self._prev_sample = self._last_sample
+            self._last_sample = (now, self._frames())
+
+        (prev_time, prev_frames), (last_time, last_frames) = (
+            self._prev_sample,
+            self._last_sample,
+        )
+        if last_time == prev_time:
+            return 0.0
+
+        return (last_frames - prev_frames) / (last_time - prev_time)
+
+    def __str__(self):
+        return (
+            f"{self.open_connections} open connections "
+            f"({self.total_connections} total, {self.rejected_connections} rejected), "
+            f"{self.bytes_in} bytes in, {self.bytes_out} bytes out, "
+            f"{self.frames_per_second:.1f} frames/s"
+        )
+
+
+class _ConnectionWriter:
+    """
+    StreamWriter wrapper, counts sent bytes and frames
+
+    Also allows to call drain() from multiple tasks.
+    """
+
+    def __init__(
+        self, writer: StreamWriter, stats: ServerStats, delimiter: Optional[bytes]
+    ):
+        self._writer = writer
+        self._stats = stats
+        self._delimiter = delimiter
+        self._drain_lock = asyncio.Lock()
+
+    def _count(self, data: bytes):
+        self._stats.bytes_out += len(data)
+        if self._delimiter is not None:
+            self._stats.frames_out += data.count(self._delimiter)
+
+    def write(self, data: bytes):
+        self._count(data)
+        self._writer.write(data)
+
+    def writelines(self, data: list[bytes]):
+        for chunk in data:
+            self._count(chunk)
+        self._writer.writelines(data)
+
+    async def drain(self):
+        async with self._drain_lock:
+            await self._writer.drain()
+
+    def __getattr__(self, name):
+        # close(), wait_closed(), get_extra_info(), etc
+        return getattr(self._writer, name)
+
+
+class _ConnectionReader:
+    """
+    StreamReader wrapper, counts received bytes and frames
+
+    Reading is paused while connection's write buffer is above the high-water mark.
+    """
+
+    def __init__(
+        self,
+        reader: StreamReader,
+        writer: _ConnectionWriter,
+        stats: ServerStats,
+        delimiter: Optional[bytes],
+    ):
+        self._reader = reader
+        self._writer = writer
+        self._stats = stats
+        self._delimiter = delimiter
+
+    def _count(self, data: bytes) -> bytes:
+        self._stats.bytes_in += len(data)
+        if self._delimiter is not None:
+            self._stats.frames_in += data.count(self._delimiter)
+
+        return data
+
+    async def read(self, n: int = -1) -> bytes:
+        # don't accept more requests, while the client is not reading our replies
+        await self._writer.drain()
+        return self._count(await self._reader.read(n))
+
+    async def readuntil(self, separator: bytes = b"\n") -> bytes:
+        await self._writer.drain()
+        return self._count(await self._reader.readuntil(separator))
+
+    async def readline(self) -> bytes:
+        await self._writer.drain()
+        return self._count(await self._reader.readline())
+
+    async def readexactly(self, n: int) -> bytes:
+        await self._writer.drain()
+        return self._count(await self._reader.readexactly(n))
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
 
 
 class AsyncTCPServer:
-    def __init__(self, port, new_connection_callback):
+    def __init__(
+        self,
+        port,
+        new_connection_callback: Callable,
+        max_connections: Optional[int] = None,
+        write_high_water: Optional[int] = None,
+        frame_delimiter: Optional[bytes] = None,
+        use_fast_loop: bool = True,
+    ):
+        """
+        max_connections  - new connections above this limit are closed right away
+        write_high_water - per connection write buffer size, in bytes, above which
+                           reading from the connection is paused
+        frame_delimiter  - protocol's end of frame marker, used to count frames
+        use_fast_loop    - use uvloop event loop in start(), if it is installed
+        """
         self._port = port
         self._new_connection_callback = new_connection_callback
+        self._max_connections = max_connections
+        self._write_high_water = write_high_water
+        self._frame_delimiter = frame_delimiter
+        self._use_fast_loop = use_fast_loop
+
+        # open connections handling tasks and their writers
+        self._connections: dict[asyncio.Task, StreamWriter] = {}
+        self.stats = ServerStats()
 
     def start(self):
         backchannel = Queue()
-        self._thread = Thread(target=lambda: asyncio.run(self._run(backchannel)))
+        self._thread = Thread(
+            target=lambda: run_event_loop(self._run(backchannel), self._use_fast_loop)
+        )
         self._thread.start()
 
         #
@@ -24,10 +222,85 @@ class AsyncTCPServer:
         self._loop.call_soon_threadsafe(self._exit_event.set)
         self._thread.join()
 
-    async def _run(self, backchannel: Queue):
-        server = await asyncio.start_server(
-            self._new_connection_callback, host="0.0.0.0", port=self._port
+    async def serve(self):
+        """
+        serve connections in the current event loop, until cancelled
+
+        Allows to run multiple servers in the same event loop,
+        as an alternative to start()/stop() API.
+        """
+        server = await self._start_server()
+        try:
+            await server.serve_forever()
+        finally:
+            await self._shutdown(server)
+
+    async def _start_server(self):
+        return await asyncio.start_server(
+            self._handle_connection, host="0.0.0.0", port=self._port
+        )
+
+    async def _shutdown(self, server: asyncio.AbstractServer):
+        """
+        stop accepting new connections, and close all open connections
+        """
+        server.close()
+
+        if self._connections:
+            #
+            # flush and close the sockets, this makes the connection callbacks
+            # see end of stream and finish, cancel the ones that don't finish in time
+            #
+            for writer in self._connections.values():
+                writer.close()
+
+            _, pending = await asyncio.wait(
+                list(self._connections.keys()), timeout=SHUTDOWN_TIMEOUT
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        await server.wait_closed()
+
+    async def _handle_connection(self, reader: StreamReader, writer: StreamWriter):
+        if (
+            self._max_connections is not None
+            and self.stats.open_connections >= self._max_connections
+        ):
+            # too many connections, refuse this one
+            self.stats.rejected_connections += 1
+            writer.close()
+            return
+
+        if self._write_high_water is not None:
+            writer.transport.set_write_buffer_limits(high=self._write_high_water)
+
+        self._connections[asyncio.current_task()] = writer
+        self.stats.open_connections += 1
+        self.stats.total_connections += 1
+
+        conn_writer = _ConnectionWriter(writer, self.stats, self._frame_delimiter)
+        conn_reader = _ConnectionReader(
+            reader, conn_writer, self.stats, self._frame_delimiter
         )
+
+        try:
+            await self._new_connection_callback(conn_reader, conn_writer)
+        finally:
+            del self._connections[asyncio.current_task()]
+            self.stats.open_connections -= 1
+
+            # make sure the socket is closed, even if the callback have failed
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                # the socket is closed, one way or another
+                pass
+
+    async def _run(self, backchannel: Queue):
+        server = await self._start_server()
         asyncio.create_task(server.serve_forever())
 
         loop = asyncio.get_running_loop()
@@ -35,3 +308,4 @@ class AsyncTCPServer:
         backchannel.put((loop, exit_event))
 
         await exit_event.wait()
+        await self._shutdown(server)
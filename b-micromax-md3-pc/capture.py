@@ -0,0 +1,192 @@
+"""
+binary capture log of exporter protocol sessions
+
+All frames exchanged with the clients are appended to a memory-mapped file,
+as length-prefixed entries. Each entry records a monotonic timestamp,
+the connection ID, the direction and the raw frame bytes. Connects and
+disconnects are recorded as entries without data.
+
+Appending an entry is just a struct.pack_into() and a copy into the mapped
+memory, it does not format any text or make any system calls, except
+when the file needs to be grown. The data is written to the file by the OS.
+
+The file starts with a header of the magic bytes and the capture start time,
+in unix epoch seconds. If the emulator is killed, the unused pre-allocated
+tail of the file is left zeroed, which the reader treats as end of the log.
+
+An existing capture file is never overwritten, it is renamed with its
+modification time added to the name, e.g. 'md3-9001-20240131-142501.cap'.
+Thus the capture of a crashed emulator is kept when the emulator is restarted.
+
+Following environment variable is used by open_capture_from_env():
+
+  EMU_CAPTURE  path of the capture file, '{port}' is replaced with
+               the exporter's TCP port, so that each exporter instance
+               gets its own file. If the path does not contain '{port}',
+               the port is added before the file extension, e.g.
+               'md3.cap' becomes 'md3-9001.cap'
+"""
+import os
+import time
+import mmap
+import struct
+from enum import IntEnum
+from typing import Iterator, Optional, NamedTuple
+
+MAGIC = b"MD3CAP1\n"
+# magic, capture start time
+_FILE_HEADER = struct.Struct("<8sd")
+# monotonic timestamp, connection ID, direction, data length
+_ENTRY_HEADER = struct.Struct("<dIBI")
+
+# the file is grown in chunks of this many bytes
+GROW_SIZE = 16 * 1024 * 1024
+
+
+class Direction(IntEnum):
+    # zero is reserved, marks the unused tail of the file
+    IN = 1
+    OUT = 2
+    CONNECT = 3
+    DISCONNECT = 4
+
+
+class Entry(NamedTuple):
+    timestamp: float
+    connection_id: int
+    direction: Direction
+    data: bytes
+
+
+def _rotate(path: str):
+    """
+    rename existing capture file, adding its modification time to the name
+    """
+    if not os.path.exists(path):
+        return
+
+    root, ext = os.path.splitext(path)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(os.path.getmtime(path)))
+    rotated = f"{root}-{stamp}{ext}"
+    suffix = 1
+    while os.path.exists(rotated):
+        rotated = f"{root}-{stamp}-{suffix}{ext}"
+        suffix += 1
+
+    os.rename(path, rotated)
+
+
+class CaptureWriter:
+    def __init__(self, path: str, grow_size: int = GROW_SIZE):
+        self._grow_size = grow_size
+        _rotate(path)
+        self._file = open(path, "w+b")
+        self._file.truncate(grow_size)
+        self._mmap = mmap.mmap(self._file.fileno(), grow_size)
+
+        _FILE_HEADER.pack_into(self._mmap, 0, MAGIC, time.time())
+        self._offset = _FILE_HEADER.size
+
+        self.entries = 0
+
+    def _grow(self, needed: int):
+        size = len(self._mmap)
+        while size - self._offset < needed:
+            size += self._grow_size
+
+        self._mmap.resize(size)
+
+    def record(self, connection_id: int, direction: Direction, data: bytes = b""):
+        size = _ENTRY_HEADER.size + len(data)
+        if len(self._mmap) - self._offset < size:
+            self._grow(size)
+
+        _ENTRY_HEADER.pack_into(
+            self._mmap,
+            self._offset,
+            time.monotonic(),
+            connection_id,
+            direction,
+            len(data),
+        )
+        start = self._offset + _ENTRY_HEADER.size
+        self._mmap[start : start + len(data)] = data
+        self._offset = start + len(data)
+
+        self.entries += 1
+
+    def record_frames(
+        self, connection_id: int, direction: Direction, frames: list[bytes]
+    ):
+        for frame in frames:
+            self.record(connection_id, direction, frame)
+
+    def close(self):
+        # drop the unused pre-allocated tail
+        self._mmap.resize(self._offset)
+        self._mmap.close()
+        self._file.close()
+
+
+class ConnectionCapture:
+    """
+    captures frames of one client connection
+    """
+
+    def __init__(self, writer: CaptureWriter, connection_id: int):
+        self._writer = writer
+        self._connection_id = connection_id
+
+        writer.record(connection_id, Direction.CONNECT)
+
+    def inbound(self, frames: list[bytes]):
+        self._writer.record_frames(self._connection_id, Direction.IN, frames)
+
+    def outbound(self, frames: list[bytes]):
+        self._writer.record_frames(self._connection_id, Direction.OUT, frames)
+
+    def close(self):
+        self._writer.record(self._connection_id, Direction.DISCONNECT)
+
+
+def read_capture(path: str) -> tuple[float, Iterator[Entry]]:
+    """
+    read capture file
+
+    returns capture start time and an iterator over the entries
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, start_time = _FILE_HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path}: not an exporter capture file")
+
+    def entries():
+        offset = _FILE_HEADER.size
+        while offset + _ENTRY_HEADER.size <= len(data):
+            timestamp, conn_id, direction, length = _ENTRY_HEADER.unpack_from(
+                data, offset
+            )
+            if direction == 0:
+                # unused tail of the file
+                return
+
+            start = offset + _ENTRY_HEADER.size
+            offset = start + length
+            yield Entry(timestamp, conn_id, Direction(direction), data[start:offset])
+
+    return start_time, entries()
+
+
+def open_capture_from_env(port: int) -> Optional[CaptureWriter]:
+    path = os.environ.get("EMU_CAPTURE")
+    if path is None:
+        return None
+
+    if "{port}" not in path:
+        # exporters sharing one file would overwrite each other's entries
+        root, ext = os.path.splitext(path)
+        path = f"{root}-{{port}}{ext}"
+
+    return CaptureWriter(path.replace("{port}", str(port)))
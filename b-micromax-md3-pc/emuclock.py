@@ -0,0 +1,82 @@
+"""
+virtual clock for the emulators
+
+All emulated delays, e.g. motor moves, task durations or robot trajectories,
+are measured with the virtual clock. The virtual clock runs 'warp' times faster
+than the real clock, thus emulated activities finish warp times sooner, but
+take the same amount of time as seen by the clients of the emulators, as long
+as the clients use the reported timestamps.
+
+The clock starts at the current time, i.e. with warp factor 1 it reads
+the same as time.time() and time.monotonic().
+
+Following environment variable is used by Clock.from_env():
+
+  EMU_TIME_WARP  clock speed factor, e.g. '10' makes emulated delays
+                 10 times shorter, default is '1', i.e. real-time
+"""
+import os
+import time
+import asyncio
+
+
+class Clock:
+    def __init__(self, warp: float = 1.0):
+        now = time.monotonic()
+        # offset between virtual epoch time and virtual monotonic clock
+        self._epoch_offset = time.time() - now
+
+        # real and virtual monotonic times of the last warp change
+        self._real_base = now
+        self._virtual_base = now
+        self._warp = 1.0
+
+        self.warp = warp
+
+    @staticmethod
+    def from_env() -> "Clock":
+        return Clock(float(os.environ.get("EMU_TIME_WARP", "1")))
+
+    @property
+    def warp(self) -> float:
+        return self._warp
+
+    @warp.setter
+    def warp(self, warp: float):
+        """
+        change clock speed, the clock continues from the current virtual time
+        """
+        if warp <= 0.0:
+            raise ValueError(f"invalid time warp factor {warp}, must be positive")
+
+        self._virtual_base = self.monotonic()
+        self._real_base = time.monotonic()
+        self._warp = warp
+
+    def monotonic(self) -> float:
+        """
+        virtual monotonic clock, in seconds
+        """
+        return self._virtual_base + (time.monotonic() - self._real_base) * self._warp
+
+    def time(self) -> float:
+        """
+        virtual time, in unix epoch seconds
+        """
+        return self._epoch_offset + self.monotonic()
+
+    def real_seconds(self, seconds: float) -> float:
+        """
+        convert virtual time interval to real time seconds
+        """
+        return seconds / self.warp
+
+    def sleep(self, seconds: float):
+        time.sleep(self.real_seconds(seconds))
+
+    async def async_sleep(self, seconds: float):
+        await asyncio.sleep(self.real_seconds(seconds))
+
+
+# the clock shared by all emulator code in the process
+clock = Clock.from_env()
@@ -1,31 +1,51 @@
 #!/usr/bin/env python3
-from typing import Optional
+from typing import Optional, Any
 import asyncio
 import sys
 import math
+import itertools
 import traceback
-from time import time
+from time import sleep
 from asyncio import StreamReader, StreamWriter, Lock
-from datetime import datetime
 from atcpserv import AsyncTCPServer
-from dataclasses import dataclass
+from motion import MotorSpec, MotionEngine
+from tasks import TaskRegistry, Task
+from raster import RasterScan
+from emulog import Logger
+from emuclock import clock
+from capture import CaptureWriter, ConnectionCapture, open_capture_from_env
+from md3state import StateWriter, STATE_ATTRIBUTES, state_path
 
-MOTOR_STEPS = 8
 PORT = 9001
+# max number of simultaneous client connections
+MAX_CONNECTIONS = 64
+# stop reading client's requests while this many bytes of replies are not yet sent
+WRITE_HIGH_WATER = 256 * 1024
+# log server statistics with this many seconds interval
+SERVER_STATS_INTERVAL = 60.0
+# ongoing activities, e.g. motor moves, are advanced in ticks,
+# with this many real-time seconds between ticks, regardless of the clock warp
+TICK_PERIOD = 0.05
+
+# max number of bytes to pull from the socket in one read
+READ_CHUNK_SIZE = 64 * 1024
+# log connection's batching statistics every this many flushes
+STATS_REPORT_FLUSHES = 1000
+# max number of not yet sent events, per connection
+MAX_PENDING_EVENTS = 1024
 
 STX = b"\02"
 ETX = b"\03"
 ARRAY_SEP = "\x1f"
 
-READ = "READ "
-WRTE = "WRTE "
+# message types, a message starts with one of these, followed by a space and the payload
+READ = "READ"
+WRTE = "WRTE"
 LIST = "LIST"
-EXEC = "EXEC "
+EXEC = "EXEC"
 
 
-def log(msg: str):
-    print(msg)
-    sys.stdout.flush()
+log = Logger.from_env(sys.stdout)
 
 
 def encode_val(val) -> str:
@@ -65,16 +85,24 @@ def encode_val(val) -> str:
     assert False, f"unsupported value type {val_type}"
 
 
-def parse_val(val_type, val):
-    def parse_bool(val: str) -> bool:
-        val = val.lower()
-        if val == "true":
-            return True
-        if val == "false":
-            return False
+def frame(msg: str) -> bytes:
+    """
+    encode message into STX..ETX frame
+    """
+    return STX + msg.encode() + ETX
+
+
+def parse_bool(val: str) -> bool:
+    val = val.lower()
+    if val == "true":
+        return True
+    if val == "false":
+        return False
 
-        assert False, f"unexpected boolean {val}"
+    raise ValueError(f"unexpected boolean {val}")
 
+
+def parse_val(val_type, val):
     if val_type == int:
         return int(val)
 
@@ -84,17 +112,20 @@ def parse_val(val_type, val):
     if val_type == float:
         return float(val)
 
-    assert False, f"unsupported value type {val_type}"
+    if val_type == str:
+        return val
 
+    raise ValueError(f"unsupported value type {val_type.__name__}")
 
-def epoch_as_text(epoch: float) -> str:
-    """
-    convert time in epoch seconds to textual date-time format
-    """
-    txt = datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M:%S.%f")
-    # cut of last 3 digit, so that seconds are returned with milliseconds precision,
-    # e.g '2023-12-12 15:44:15.695130' becomes '2023-12-12 15:44:15.695'
-    return txt[:-3]
+
+# parsers for command arguments, by the argument type name used in command signatures
+ARG_PARSERS = {
+    "int": int,
+    "double": float,
+    "boolean": parse_bool,
+    "String": str,
+    "Phase": str,
+}
 
 
 class UnknownAttribute(Exception):
@@ -109,42 +140,258 @@ class CommandError(Exception):
     pass
 
 
+class CompiledCommand:
+    """
+    MD3 command, with argument parsers generated from the declared signature
+    """
+
+    def __init__(self, name: str, ret_type: str, args: str, method):
+        self.name = name
+        # command description, as used in LIST reply
+        self.signature = f"{ret_type} {name}({args})"
+        self._method = method
+
+        arg_types = [arg.strip() for arg in args.split(",") if arg.strip() != ""]
+        self._parsers = [ARG_PARSERS[arg_type] for arg_type in arg_types]
+
+    def __call__(self, raw_args: list[str]):
+        if len(raw_args) != len(self._parsers):
+            raise CommandError(
+                f"{self.name}: expected {len(self._parsers)} arguments, "
+                f"got {len(raw_args)}"
+            )
+
+        try:
+            args = [parse(arg) for parse, arg in zip(self._parsers, raw_args)]
+        except ValueError as ex:
+            raise CommandError(f"{self.name}: invalid argument: {ex}")
+
+        return self._method(*args)
+
+
 class SynchronizedWriter:
-    def __init__(self, writer: StreamWriter):
+    def __init__(self, writer: StreamWriter, capture: Optional[ConnectionCapture]):
         self._writer = writer
+        self._capture = capture
         self._lock = Lock()
 
-    async def write_drain(self, msg):
+    async def writelines_drain(self, msgs: list[bytes]):
         async with self._lock:
-            self._writer.write(msg)
+            if self._capture is not None:
+                self._capture.outbound(msgs)
+            self._writer.writelines(msgs)
             await self._writer.drain()
 
 
-@dataclass
-class Task:
-    name: str
-    # times are in unix epoch seconds
-    start_time: float
-    end_time: float
+def _is_state_attribute(attr_name: str) -> bool:
+    return attr_name.endswith("State")
 
-    def is_running(self) -> bool:
-        return self.end_time > time()
 
+class EventSubscriber:
+    """
+    outbound EVT queue of one connection
+
+    While the connection is keeping up, all events are sent, in the order they
+    were published. While an events write to the client is not yet drained,
+    new events are coalesced per attribute, only the latest value is kept.
+    Thus a stalled client costs at most one queued event per attribute.
+
+    State attributes' events are never coalesced, so that the clients see
+    all the state transitions, e.g. 'Moving' before 'Ready'.
+    """
+
+    def __init__(self, writer: SynchronizedWriter):
+        self._writer = writer
+        # event key -> encoded EVT frame, in the order to be sent, the key is
+        # the attribute name for coalesced events, unique otherwise
+        self._pending: dict[Any, bytes] = {}
+        self._sequence = itertools.count()
+        self._pending_set = asyncio.Event()
+        # is an events write in progress?
+        self._writing = False
+        self._task = None
+
+        self.sent = 0
+        self.coalesced = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    def put(self, attr_name: str, frame: bytes):
+        if self._writing and not _is_state_attribute(attr_name):
+            # client is busy receiving, latest value wins,
+            # the new event is sent after other pending events
+            key = attr_name
+            if self._pending.pop(key, None) is not None:
+                self.coalesced += 1
+        else:
+            key = (attr_name, next(self._sequence))
+
+        if len(self._pending) >= MAX_PENDING_EVENTS:
+            # should not happen with a sane number of attributes, but stay bounded
+            self._pending.pop(next(iter(self._pending)))
+            self.coalesced += 1
+
+        self._pending[key] = frame
+        self._pending_set.set()
+
+    async def _run(self):
+        while True:
+            await self._pending_set.wait()
+            self._pending_set.clear()
+
+            frames = list(self._pending.values())
+            self._pending.clear()
+
+            self._writing = True
+            try:
+                await self._writer.writelines_drain(frames)
+            except ConnectionError:
+                # client have disconnected
+                return
+            finally:
+                self._writing = False
+
+            self.sent += len(frames)
+
+
+class EventBus:
+    """
+    sends attribute change events to all connected clients
+    """
+
+    def __init__(self):
+        self._subscribers: set[EventSubscriber] = set()
+
+    def subscribe(self, writer: SynchronizedWriter) -> EventSubscriber:
+        subscriber = EventSubscriber(writer)
+        subscriber.start()
+        self._subscribers.add(subscriber)
+
+        return subscriber
+
+    def unsubscribe(self, subscriber: EventSubscriber):
+        self._subscribers.discard(subscriber)
+        subscriber.stop()
+
+    def publish(self, attr_name: str, val):
+        timestamp = int(clock.time())
+        msg = f"EVT:{attr_name}\t{encode_val(val)}\t{timestamp}\torg.embl.State"
+
+        # the event frame is encoded once, and shared by all subscribers
+        evt_frame = frame(msg)
+        log.frame("<", evt_frame)
+
+        for subscriber in self._subscribers:
+            subscriber.put(attr_name, evt_frame)
+
+
+class FrameParser:
+    """
+    splits the incoming byte stream into STX..ETX framed messages
+
+    Keeps any trailing incomplete frame buffered until the rest of it arrives.
+    The frames are returned as received, each frame is decoded separately
+    with decode_frame(), so that a malformed frame does not affect the others.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """
+        add received data, return all complete frames now in the buffer,
+        without the terminating ETX bytes
+        """
+        self._buffer += data
+
+        end = self._buffer.rfind(ETX)
+        if end == -1:
+            # no complete frame yet
+            return []
+
+        chunk = bytes(self._buffer[: end + 1])
+        del self._buffer[: end + 1]
+
+        # the last element after split is always the empty string after final ETX
+        frames = chunk.split(ETX)[:-1]
+        for data in frames:
+            log.frame(">", data)
+
+        return frames
+
+
+def decode_frame(data: bytes) -> str:
+    """
+    get the message from a received frame, without the terminating ETX byte
+
+    raises ValueError for malformed frames
+    """
+    if not data.startswith(STX):
+        raise ValueError(f"frame does not start with STX: {data!r}")
+
+    # chop off STX byte, UnicodeDecodeError is a ValueError
+    return data[1:].decode()
+
+
+class ConnectionStats:
+    """
+    keeps track of how well replies are batched on a connection
+    """
 
-class MD3Up:
     def __init__(self):
-        self._synchronization_id = 0
+        self.frames = 0
+        self.flushes = 0
+        self.max_frames_per_flush = 0
 
-        self._tasks = {}
+    def add_flush(self, num_frames: int):
+        self.frames += num_frames
+        self.flushes += 1
+        self.max_frames_per_flush = max(self.max_frames_per_flush, num_frames)
+
+    @property
+    def frames_per_flush(self) -> float:
+        if self.flushes == 0:
+            return 0.0
+
+        return self.frames / self.flushes
+
+    def __str__(self):
+        return (
+            f"{self.frames} frames in {self.flushes} flushes, "
+            f"{self.frames_per_flush:.2f} frames per flush "
+            f"(max {self.max_frames_per_flush})"
+        )
+
+
+class MD3Up:
+    def __init__(self, state: Optional[StateWriter] = None):
+        # if not None, the state shared with the video camera is published here
+        self._state = state
+        self._tasks = TaskRegistry()
+        # currently running raster scan, if any
+        self._raster: Optional[RasterScan] = None
+        # (attribute name, new value) of modifications not yet reported by tick()
+        self._changes = []
+
+        # encoded READ reply frames, by attribute name
+        self._read_replies: dict[str, bytes] = {}
+        self.read_cache_hits = 0
+        self.read_cache_misses = 0
 
         self._motors = {
-            # name: (limits)
-            "AlignmentX": (-5.6, 6.1),
-            "AlignmentY": (-77.0, 2.0),
-            "AlignmentZ": (-3.399, 6.1),
-            "Omega": (-math.inf, math.inf),
-            "CentringX": (-3.05, 3.05),
-            "CentringY": (-3.05, 3.5),
+            # name: MotorSpec(limits, velocity, acceleration)
+            "AlignmentX": MotorSpec(-5.6, 6.1, 2.5, 10.0),
+            "AlignmentY": MotorSpec(-77.0, 2.0, 2.5, 10.0),
+            "AlignmentZ": MotorSpec(-3.399, 6.1, 2.5, 10.0),
+            # Omega is a rotation angle motor, thus a special case.
+            # MD3 automatically wraps any set value within 0..360 degrees range.
+            "Omega": MotorSpec(-math.inf, math.inf, 180.0, 720.0, wraps=True),
+            "CentringX": MotorSpec(-3.05, 3.05, 2.0, 10.0),
+            "CentringY": MotorSpec(-3.05, 3.5, 2.0, 10.0),
         }
 
         self._attrs = {
@@ -199,6 +446,11 @@ class MD3Up:
             "State": "Ready",
         }
 
+        self._motion = MotionEngine(
+            self._motors,
+            {name: self._attrs[f"{name}Position"] for name in self._motors},
+        )
+
         self._commands = {
             # double[] getMotorLimits(String)
             "getMotorLimits": ("double[]", "String", self._do_get_motor_limits),
@@ -231,43 +483,110 @@ class MD3Up:
             # void abort()
             "abort": ("void", "", self._do_abort),
         }
+        self._commands = {
+            name: CompiledCommand(name, ret_type, args, method)
+            for name, (ret_type, args, method) in self._commands.items()
+        }
+
+        if self._state is not None:
+            self._state.update(self._attrs)
+
+    def _attribute_changed(self, name: str):
+        self._read_replies.pop(name, None)
+        if self._state is not None and name in STATE_ATTRIBUTES:
+            self._state.update(self._attrs)
+
+    def _set_attribute(self, name: str, value):
+        self._attrs[name] = value
+        self._attribute_changed(name)
+        self._changes.append((name, value))
+
+    def _add_task(self, name: str, running_time: float) -> int:
+        task = self._tasks.add(name, running_time, clock.time())
+        self._set_attribute("State", "Running")
 
-    def _add_task(self, name: str, running_time: float):
-        def get_synchronization_id():
-            self._synchronization_id += 1
-            return self._synchronization_id
+        return task.task_id
 
-        task_id = get_synchronization_id()
-        now = time()
-        self._tasks[task_id] = Task(name, now, now + running_time)
+    def _tasks_finished(self, tasks: list[Task]):
+        if not tasks:
+            return
 
-        return task_id
+        self._set_attribute("LastTaskInfo", tasks[-1].info())
+        if not self._tasks.has_running():
+            self._set_attribute("State", "Ready")
+
+    def _expire_tasks(self):
+        self._tasks_finished(self._tasks.expire(clock.time()))
+
+    def _get_task(self, task_id: int) -> Task:
+        self._expire_tasks()
 
-    def _get_task(self, task_id: str) -> Task:
-        task_id = int(task_id)
         task = self._tasks.get(task_id)
         if task is None:
             raise CommandError(f"Invalid task: {task_id}")
 
         return task
 
-    def _do_get_motor_limits(self, motor_name) -> tuple[float, float]:
-        return self._motors[motor_name]
+    def _do_get_motor_limits(self, motor_name: str) -> tuple[float, float]:
+        motor = self._motors.get(motor_name)
+        if motor is None:
+            raise CommandError(f"Invalid motor: {motor_name}")
+
+        return motor.low_limit, motor.high_limit
+
+    def _do_start_set_phase(self, phase: str) -> int:
+        return self._add_task(f"Set {phase.upper()} PHASE", 2.3)
 
-    def _do_start_set_phase(self, _phase) -> int:
-        return self._add_task(f"Set {_phase.upper()} PHASE", 2.3)
+    def _set_motors_state(self, motor_names: list[str], state: str):
+        for motor_name in motor_names:
+            self._set_attribute(f"{motor_name}State", state)
 
     def _do_start_raster_scan(
         self,
-        _vertical_range,
-        _horizontal_range,
-        _vert_num_frames,
-        _horiz_num_frames,
-        _enable_reverse_direction,
-        _use_centring_table,
+        vertical_range,
+        horizontal_range,
+        vert_num_frames,
+        horiz_num_frames,
+        enable_reverse_direction,
+        use_centring_table,
         _fast_scan,
     ) -> int:
-        return self._add_task("Start RASTER SCAN", 5.2)
+        if vert_num_frames < 1 or horiz_num_frames < 1:
+            raise CommandError(
+                f"invalid raster scan grid {vert_num_frames}x{horiz_num_frames}"
+            )
+
+        if self._raster is not None:
+            raise CommandError("raster scan already running")
+
+        scan = RasterScan(
+            {name: self._attrs[f"{name}Position"] for name in self._motors},
+            self._attrs["OmegaPosition"],
+            vertical_range,
+            horizontal_range,
+            vert_num_frames,
+            horiz_num_frames,
+            enable_reverse_direction,
+            use_centring_table,
+            self._attrs["ScanExposureTime"],
+            clock.time(),
+        )
+        self._raster = scan
+        self._set_motors_state(scan.motors, "Moving")
+
+        # the task ends at the same time as the last line
+        return self._add_task("Start RASTER SCAN", scan.duration)
+
+    def _advance_raster(self):
+        scan = self._raster
+
+        for motor_name, position in scan.advance(clock.time()):
+            self._motion.set_position(motor_name, position)
+            self._set_attribute(f"{motor_name}Position", position)
+
+        if scan.is_finished():
+            self._set_motors_state(scan.motors, "Ready")
+            self._raster = None
 
     def _do_start_scan_ex(
         self,
@@ -279,38 +598,25 @@ class MD3Up:
     ) -> int:
         return self._add_task("Start SCAN", 3.2)
 
-    def _do_is_task_running(self, task_id) -> bool:
+    def _do_is_task_running(self, task_id: int) -> bool:
         task = self._get_task(task_id)
-        return task.is_running()
-
-    def _do_get_task_info(self, task_id):
-        def get_reply_vals():
-            if task.is_running():
-                return "", "", "", ""
-
-            # finished, aka not running
-            return epoch_as_text(task.end_time), "true", "null", "1"
+        return not task.finished
 
+    def _do_get_task_info(self, task_id: int):
         task = self._get_task(task_id)
-        end_time, result, exception, result_id = get_reply_vals()
-
-        return [
-            task.name,
-            "8",
-            epoch_as_text(task.start_time),
-            end_time,
-            result,
-            exception,
-            result_id,
-        ]
+        return task.info()
 
     def _do_save_centring_positions(self):
         # this is NOP for now
         pass
 
     def _do_abort(self):
-        # this is NOP for now
-        pass
+        self._motion.abort()
+        if self._raster is not None:
+            self._set_motors_state(self._raster.motors, "Ready")
+            self._raster = None
+
+        self._tasks_finished(self._tasks.abort(clock.time()))
 
     def _do_get_motor_dynamic_limits(self, _motor_name: str):
         # return some plausible dummy values for now
@@ -333,6 +639,50 @@ class MD3Up:
 
         return motor_name
 
+    def move_motor(self, motor_name: str, position: float):
+        self._motion.move(motor_name, position)
+
+    def is_busy(self) -> bool:
+        """
+        true if there is some ongoing activity, that needs to be advanced with tick()
+        """
+        return (
+            self._motion.is_moving()
+            or self._raster is not None
+            or self._tasks.has_running()
+            or len(self._changes) > 0
+        )
+
+    def tick(self, dt: float) -> list[tuple[str, Any]]:
+        """
+        advance all ongoing activities by dt seconds
+
+        returns list of (attribute name, new value) of all modified attributes
+        """
+        for motor_name, state, position in self._motion.tick(dt):
+            state_attr = f"{motor_name}State"
+
+            # report 'Moving' state, even for moves that are finished in one tick,
+            # the state events are not coalesced, thus clients get both
+            # 'Moving' and 'Ready' events, in that order
+            if self._attrs[state_attr] != "Moving":
+                self._set_attribute(state_attr, "Moving")
+
+            self._set_attribute(f"{motor_name}Position", position)
+
+            if state == "Ready":
+                self._set_attribute(state_attr, state)
+
+        # advance the scan before expiring tasks, so that the raster scan's
+        # last line is reported before the task is finished
+        if self._raster is not None:
+            self._advance_raster()
+
+        self._expire_tasks()
+
+        changes, self._changes = self._changes, []
+        return changes
+
     def read_attribute(self, attribute_name: str):
         val = self._attrs.get(attribute_name)
         if val is None:
@@ -340,159 +690,262 @@ class MD3Up:
 
         return val
 
+    def read_attribute_reply(self, attribute_name: str) -> bytes:
+        """
+        get READ reply frame for the attribute
+
+        The encoded replies are cached until the attribute is modified.
+        """
+        reply = self._read_replies.get(attribute_name)
+        if reply is not None:
+            self.read_cache_hits += 1
+            return reply
+
+        self.read_cache_misses += 1
+        val = self.read_attribute(attribute_name)
+        reply = frame(f"RET:{encode_val(val)}")
+        self._read_replies[attribute_name] = reply
+
+        return reply
+
     def write_attribute(self, attribute_name: str, attribute_value):
         if attribute_name not in self._attrs:
             raise UnknownAttribute()
 
         self._attrs[attribute_name] = attribute_value
+        self._attribute_changed(attribute_name)
 
     def list_commands(self):
-        for name, (ret_type, args, _) in self._commands.items():
-            yield name, ret_type, args
+        for cmd in self._commands.values():
+            yield cmd.signature
 
-    def exec_command(self, command_name, command_args):
+    def exec_command(self, command_name, command_args: list[str]):
         cmd = self._commands.get(command_name)
         if cmd is None:
             raise UnknownCommand()
 
-        _, _, cmd_method = cmd
-        return cmd_method(*command_args)
+        return cmd(command_args)
 
 
 class Exporter:
-    def __init__(self):
-        self._md3 = MD3Up()
-
-    async def _write_reply(self, writer: SynchronizedWriter, reply: str):
-        msg = STX + reply.encode() + ETX
-
-        await writer.write_drain(msg)
-
-        log(f"< {msg}")
-
-    async def _read_message(self, reader: StreamReader) -> str:
-        message = await reader.readuntil(ETX)
-
-        log(f"> {message}")
-
-        # assert that message starts with STX byte
-        assert message[0] == STX[0]
+    def __init__(
+        self,
+        name: str = "MD3",
+        capture: Optional[CaptureWriter] = None,
+        state: Optional[StateWriter] = None,
+    ):
+        # used to tell apart log messages from multiple exporter instances
+        self._name = name
+        # if not None, all sessions frames are recorded to this capture log
+        self._capture = capture
+        self._last_connection_id = 0
+        self._md3 = MD3Up(state)
+        self._events = EventBus()
+        self._ticker = None
+
+        # LIST reply never changes, build it once
+        self._list_reply = frame("RET:" + "\t".join(self._md3.list_commands()))
+
+        self._handlers = {
+            READ: self._handle_read,
+            WRTE: self._handle_write,
+            EXEC: self._handle_exec,
+            LIST: self._handle_list,
+        }
 
-        # chop off STX and ETX bytes
-        return message[1:-1].decode()
+        # load statistics, the connections are counted by the server
+        self.messages_handled = 0
 
-    async def _update_attribute(self, writer: SynchronizedWriter, name: str, val):
+    def _update_attribute(self, name: str, val):
         self._md3.write_attribute(name, val)
+        self._events.publish(name, val)
 
-        timestamp = int(time())
-        msg = f"EVT:{name}\t{val}\t{timestamp}\torg.embl.State"
-
-        await self._write_reply(writer, msg)
-
-    async def _move_motor(
-        self, writer: SynchronizedWriter, motor_name: str, new_pos: float
-    ):
-        motor_pos_attr = f"{motor_name}Position"
-        motor_state_attr = f"{motor_name}State"
+    def _start_ticker(self):
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._run_ticker())
 
-        start_pos = self._md3.read_attribute(motor_pos_attr)
-        step = (new_pos - start_pos) / MOTOR_STEPS
+    async def _run_ticker(self):
+        """
+        advance MD3 activities at a fixed rate, until it goes idle
+        """
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        last_tick = clock.monotonic()
 
-        await self._update_attribute(writer, motor_state_attr, "Moving")
+        while self._md3.is_busy():
+            next_tick += TICK_PERIOD
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
 
-        for n in range(1, MOTOR_STEPS + 1):
-            step_pos = start_pos + (n * step)
+            # activities are advanced in virtual time
+            now = clock.monotonic()
+            changes = self._md3.tick(now - last_tick)
+            last_tick = now
 
-            # Omega is a rotation angle motor, thus a special case.
-            # MD3 automatically wraps any set value within 0..360 degrees range.
-            if motor_name == "Omega":
-                step_pos = step_pos % 360.0
+            for name, val in changes:
+                self._events.publish(name, val)
 
-            await self._update_attribute(writer, motor_pos_attr, step_pos)
-            await asyncio.sleep(2 / MOTOR_STEPS)
-
-        await self._update_attribute(writer, motor_state_attr, "Ready")
-
-    def _handle_read(self, attr_name: str) -> str:
+    def _handle_read(self, attr_name: str) -> bytes:
         try:
-            val = self._md3.read_attribute(attr_name)
-            return f"RET:{encode_val(val)}"
+            return self._md3.read_attribute_reply(attr_name)
         except UnknownAttribute:
-            log(f"WARNING: read command for an unknown attribute '{attr_name}'")
+            log.warning(f"read command for an unknown attribute '{attr_name}'")
             # this seems to be the error message MD3UP generates for unknown attributes
-            return f"ERR:Undefined method: true.get{attr_name}"
+            return frame(f"ERR:Undefined method: true.get{attr_name}")
 
-    def _handle_write(self, slug: str, writer: SynchronizedWriter) -> str:
-        name, val = slug.split(" ", 2)
-        attr_type = type(self._md3.read_attribute(name))
-        val = parse_val(attr_type, val)
+    def _handle_write(self, slug: str) -> bytes:
+        name, _, val = slug.partition(" ")
+        try:
+            attr_type = type(self._md3.read_attribute(name))
+            val = parse_val(attr_type, val)
+        except UnknownAttribute:
+            log.warning(f"write command for an unknown attribute '{name}'")
+            return frame(f"ERR:Undefined method: true.set{name}")
+        except ValueError as ex:
+            return frame(f"ERR:invalid value for {name}: {ex}")
 
         motor_name = self._md3.get_motor_name(name)
         if motor_name is None:
             # this is a motor position attribute, emulate moving motor
-            asyncio.create_task(self._update_attribute(writer, name, val))
+            self._update_attribute(name, val)
         else:
-            asyncio.create_task(self._move_motor(writer, motor_name, val))
+            self._md3.move_motor(motor_name, val)
+            self._start_ticker()
 
-        return "NULL"
+        return frame("NULL")
 
-    def _handle_exec(self, command: str) -> str:
-        cmd_name, args = command.split(" ", 1)
+    def _handle_exec(self, command: str) -> bytes:
+        cmd_name, _, args = command.partition(" ")
+        args = args.strip()
         if args == "":
             # no arguments specified
             args = []
         else:
-            args = args.strip().split("\t")
+            args = args.split("\t")
 
         try:
             ret = self._md3.exec_command(cmd_name, args)
+        except UnknownCommand:
+            log.warning(f"exec of an unknown command '{cmd_name}'")
+            return frame(f"ERR:Undefined method: true.{cmd_name}")
         except CommandError as cmd_err:
-            return f"ERR:{str(cmd_err)}"
+            return frame(f"ERR:{str(cmd_err)}")
 
-        return f"RET:{encode_val(ret)}"
+        if self._md3.is_busy():
+            # the command have started some activity
+            self._start_ticker()
 
-    def _handle_list(self) -> str:
-        def commands():
-            for name, ret_type, args in self._md3.list_commands():
-                yield f"{ret_type} {name}({args})"
+        return frame(f"RET:{encode_val(ret)}")
 
-        cmds = "\t".join(list(commands()))
+    def _handle_list(self, _) -> bytes:
+        return self._list_reply
 
-        return f"RET:{cmds}"
-
-    async def _handle_message(self, msg: str, writer: SynchronizedWriter):
-        def get_reply():
-            if msg.startswith(READ):
-                return self._handle_read(msg[len(READ) :])
+    def _handle_message(self, msg: str) -> bytes:
+        msg_type, _, payload = msg.partition(" ")
+        handler = self._handlers.get(msg_type)
+        if handler is None:
+            log.warning(f"unexpected message '{msg}'")
+            reply = frame(f"ERR:unexpected message '{msg}'")
+        else:
+            reply = handler(payload)
 
-            if msg.startswith(WRTE):
-                return self._handle_write(msg[len(WRTE) :], writer)
+        log.frame("<", reply)
 
-            if msg.startswith(EXEC):
-                return self._handle_exec(msg[len(EXEC) :])
+        return reply
 
-            if msg.startswith(LIST):
-                return self._handle_list()
+    def _handle_frame(self, data: bytes) -> bytes:
+        """
+        handle one received frame
 
-            assert False, f"unexpected message '{msg}'"
+        Any error is replied with an ERR frame, so that the rest of
+        the pipelined frames are handled and replied as usual.
+        """
+        try:
+            return self._handle_message(decode_frame(data))
+        except Exception as ex:
+            log.error(f"error handling frame {data!r}: {ex}\n{traceback.format_exc()}")
+            reply = frame(f"ERR:{ex}")
+            log.frame("<", reply)
 
-        await self._write_reply(writer, get_reply())
+            return reply
 
     async def new_connection(self, reader: StreamReader, writer: StreamWriter):
-        log("MD3 new connection")
+        log.info(f"{self._name} new connection")
+
+        capture = None
+        if self._capture is not None:
+            self._last_connection_id += 1
+            capture = ConnectionCapture(self._capture, self._last_connection_id)
 
-        sync_writer = SynchronizedWriter(writer)
+        sync_writer = SynchronizedWriter(writer, capture)
+        subscriber = self._events.subscribe(sync_writer)
+        parser = FrameParser()
+        stats = ConnectionStats()
 
         try:
-            while True:
-                msg = await self._read_message(reader)
-                await self._handle_message(msg, sync_writer)
+            while (data := await reader.read(READ_CHUNK_SIZE)) != b"":
+                frames = parser.feed(data)
+                if not frames:
+                    # no complete frame received yet
+                    continue
+
+                if capture is not None:
+                    capture.inbound([data + ETX for data in frames])
+
+                #
+                # handle all the frames we have received in one go,
+                # and send all the replies in one write
+                #
+                replies = [self._handle_frame(data) for data in frames]
+                self.messages_handled += len(replies)
+                await sync_writer.writelines_drain(replies)
+
+                stats.add_flush(len(replies))
+                if stats.flushes % STATS_REPORT_FLUSHES == 0:
+                    log.info(f"{self._name} connection: {stats}")
+        except ConnectionError as ex:
+            log.info(f"{self._name} connection lost: {ex}")
         except Exception as ex:
-            log(f"error: {str(ex)}")
-            traceback.print_exception(ex)
-
-
-exporter = Exporter()
-tcp_srv = AsyncTCPServer(PORT, exporter.new_connection)
-log("MD3 exporter emulator starting")
-tcp_srv.start()
+            log.error(f"{str(ex)}\n{traceback.format_exc()}")
+        finally:
+            self._events.unsubscribe(subscriber)
+            if capture is not None:
+                capture.close()
+
+        log.info(
+            f"{self._name} connection closed: {stats}, "
+            f"{subscriber.sent} events sent, {subscriber.coalesced} coalesced, "
+            f"read cache {self._md3.read_cache_hits} hits "
+            f"{self._md3.read_cache_misses} misses"
+        )
+
+
+def create_server(port: int, exporter: Exporter) -> AsyncTCPServer:
+    return AsyncTCPServer(
+        port,
+        exporter.new_connection,
+        max_connections=MAX_CONNECTIONS,
+        write_high_water=WRITE_HIGH_WATER,
+        frame_delimiter=ETX,
+    )
+
+
+def main():
+    capture = open_capture_from_env(PORT)
+    state = StateWriter(state_path(PORT))
+    tcp_srv = create_server(PORT, Exporter(capture=capture, state=state))
+    log.info("MD3 exporter emulator starting")
+    tcp_srv.start()
+
+    try:
+        while True:
+            sleep(SERVER_STATS_INTERVAL)
+            log.info(f"MD3 server: {tcp_srv.stats}")
+    except KeyboardInterrupt:
+        tcp_srv.stop()
+        state.close()
+        if capture is not None:
+            capture.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Load generator and latency benchmark for MD3 exporter protocol.
+
+Opens a number of connections to an exporter, and sends a configurable mix
+of READ, WRTE, EXEC and LIST messages on each connection for a fixed duration.
+Measures the throughput and reply latencies, overall and per message type.
+
+After the load phase, measures the delay from a motor position WRTE to
+the first position EVT and to the motor's 'Ready' state EVT.
+
+The results are written as a JSON document, so that runs can be compared.
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import subprocess
+from typing import Optional
+from collections import deque
+from argparse import ArgumentParser
+from asyncio import StreamReader, StreamWriter
+
+STX = b"\02"
+ETX = b"\03"
+
+READ_ATTRIBUTES = [
+    "OmegaPosition",
+    "OmegaState",
+    "AlignmentXPosition",
+    "CentringXPosition",
+    "ApertureDiameters",
+    "CoaxialCameraZoomValue",
+    "LastTaskInfo",
+    "State",
+]
+
+# message generators, by message type
+MESSAGES = {
+    "READ": lambda: f"READ {random.choice(READ_ATTRIBUTES)}",
+    "WRTE": lambda: f"WRTE BackLightFactor {random.uniform(0.0, 2.0)}",
+    "EXEC": lambda: f"EXEC getMotorLimits {random.choice(['Omega', 'CentringX'])}",
+    "LIST": lambda: "LIST",
+}
+
+MOTOR = "AlignmentX"
+# motor move step for WRTE to EVT measurements
+MOTOR_STEP = 0.01
+
+# max time to wait for a reply or an event, in seconds
+REPLY_TIMEOUT = 5.0
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """
+    parse messages mix specification, e.g. 'READ=80,EXEC=20'
+    """
+    weights = {}
+    for part in mix.split(","):
+        msg_type, _, weight = part.partition("=")
+        msg_type = msg_type.strip().upper()
+        if msg_type not in MESSAGES:
+            raise ValueError(f"unknown message type '{msg_type}'")
+        weights[msg_type] = float(weight)
+
+    return weights
+
+
+def parse_args():
+    parser = ArgumentParser(description="Benchmark MD3 exporter emulator")
+
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("-p", "--port", type=int, default=9001)
+    parser.add_argument(
+        "-c", "--connections", type=int, default=4, help="number of connections"
+    )
+    parser.add_argument(
+        "-d",
+        "--depth",
+        type=int,
+        default=1,
+        help="number of outstanding requests per connection",
+    )
+    parser.add_argument(
+        "-t", "--duration", type=float, default=10.0, help="load phase seconds"
+    )
+    parser.add_argument(
+        "-m",
+        "--mix",
+        type=parse_mix,
+        default="READ=80,WRTE=5,EXEC=10,LIST=5",
+        help="message mix as TYPE=WEIGHT list, default: %(default)s",
+    )
+    parser.add_argument(
+        "--motor-moves",
+        type=int,
+        default=20,
+        help="number of motor moves for WRTE to EVT measurement, 0 to skip",
+    )
+    parser.add_argument("-o", "--output", help="write results to file")
+
+    return parser.parse_args()
+
+
+def latency_summary(samples: list[float]) -> dict:
+    """
+    summarize samples, in milliseconds
+    """
+    if not samples:
+        return dict(count=0)
+
+    samples = sorted(samples)
+
+    def percentile(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000.0
+
+    return dict(
+        count=len(samples),
+        mean=sum(samples) / len(samples) * 1000.0,
+        p50=percentile(0.50),
+        p95=percentile(0.95),
+        p99=percentile(0.99),
+        max=samples[-1] * 1000.0,
+    )
+
+
+class _Connection:
+    def __init__(self, reader: StreamReader, writer: StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._buffer = b""
+
+    async def read_frames(self) -> list[bytes]:
+        """
+        wait for incoming data, return all complete frames, without STX and ETX
+        """
+        while True:
+            data = await self._reader.read(64 * 1024)
+            if data == b"":
+                raise ConnectionError("connection closed by exporter")
+
+            self._buffer += data
+            end = self._buffer.rfind(ETX)
+            if end == -1:
+                continue
+
+            frames = self._buffer[: end + 1].split(ETX)[:-1]
+            self._buffer = self._buffer[end + 1 :]
+
+            return [frame[1:] for frame in frames]
+
+    def send(self, msg: str):
+        self._writer.write(STX + msg.encode() + ETX)
+
+    def close(self):
+        self._writer.close()
+
+
+class _LoadClient:
+    """
+    sends messages on one connection, measures replies latencies
+    """
+
+    def __init__(self, connection: _Connection, mix: dict[str, float], depth: int):
+        self._conn = connection
+        self._msg_types = list(mix.keys())
+        self._weights = list(mix.values())
+        self._slots = asyncio.Semaphore(depth)
+        # (message type, send time) of requests waiting for reply
+        self._pending = deque()
+
+        self.latencies: dict[str, list[float]] = {t: [] for t in self._msg_types}
+        self.errors = 0
+        self.events = 0
+        self.timeouts = 0
+
+    async def _send(self, deadline: float):
+        while time.monotonic() < deadline:
+            try:
+                await asyncio.wait_for(self._slots.acquire(), REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                # no replies for too long, the exporter is stuck
+                self.timeouts += 1
+                return
+
+            msg_type = random.choices(self._msg_types, self._weights)[0]
+            self._pending.append((msg_type, time.monotonic()))
+            self._conn.send(MESSAGES[msg_type]())
+
+    async def _receive(self):
+        while True:
+            frames = await self._conn.read_frames()
+            now = time.monotonic()
+
+            for frame in frames:
+                if frame.startswith(b"EVT:"):
+                    self.events += 1
+                    continue
+
+                msg_type, sent = self._pending.popleft()
+                self.latencies[msg_type].append(now - sent)
+                if frame.startswith(b"ERR:"):
+                    self.errors += 1
+
+                self._slots.release()
+
+    async def run(self, duration: float):
+        receiver = asyncio.create_task(self._receive())
+        await self._send(time.monotonic() + duration)
+
+        # wait for outstanding replies, but don't hang on a stuck exporter
+        for _ in range(100):
+            if not self._pending:
+                break
+            await asyncio.sleep(0.05)
+
+        receiver.cancel()
+
+
+async def _connect(host: str, port: int) -> _Connection:
+    reader, writer = await asyncio.open_connection(host, port)
+    return _Connection(reader, writer)
+
+
+async def _run_load(args) -> dict:
+    connections = [
+        await _connect(args.host, args.port) for _ in range(args.connections)
+    ]
+    clients = [_LoadClient(conn, args.mix, args.depth) for conn in connections]
+
+    start = time.monotonic()
+    await asyncio.gather(*[client.run(args.duration) for client in clients])
+    elapsed = time.monotonic() - start
+
+    for conn in connections:
+        conn.close()
+
+    per_type = {}
+    all_latencies = []
+    for msg_type in args.mix.keys():
+        latencies = [lat for c in clients for lat in c.latencies[msg_type]]
+        per_type[msg_type] = latency_summary(latencies)
+        all_latencies += latencies
+
+    return dict(
+        elapsed=elapsed,
+        messages=len(all_latencies),
+        throughput=len(all_latencies) / elapsed,
+        errors=sum(c.errors for c in clients),
+        timeouts=sum(c.timeouts for c in clients),
+        events_received=sum(c.events for c in clients),
+        latency_ms=latency_summary(all_latencies),
+        latency_ms_by_type=per_type,
+    )
+
+
+async def _wait_event(conn: _Connection, prefix: bytes, pending: deque) -> float:
+    """
+    wait for an EVT frame starting with prefix, returns the time it was received
+    """
+    while True:
+        while pending:
+            if pending.popleft().startswith(prefix):
+                return time.monotonic()
+
+        pending.extend(await conn.read_frames())
+
+
+async def _run_motor_moves(args) -> dict:
+    conn = await _connect(args.host, args.port)
+    frames = deque()
+
+    conn.send(f"READ {MOTOR}Position")
+    while not frames:
+        frames.extend(await conn.read_frames())
+    position = float(frames.popleft()[len(b"RET:") :])
+
+    first_event = []
+    move_done = []
+    timeouts = 0
+
+    for n in range(args.motor_moves):
+        # move back and forth
+        position += MOTOR_STEP if n % 2 == 0 else -MOTOR_STEP
+
+        sent = time.monotonic()
+        conn.send(f"WRTE {MOTOR}Position {position}")
+        try:
+            received = await asyncio.wait_for(
+                _wait_event(conn, f"EVT:{MOTOR}Position".encode(), frames),
+                REPLY_TIMEOUT,
+            )
+            first_event.append(received - sent)
+
+            received = await asyncio.wait_for(
+                _wait_event(conn, f"EVT:{MOTOR}State\tReady".encode(), frames),
+                REPLY_TIMEOUT,
+            )
+            move_done.append(received - sent)
+        except asyncio.TimeoutError:
+            timeouts += 1
+
+    conn.close()
+
+    return dict(
+        motor=MOTOR,
+        step=MOTOR_STEP,
+        first_event_ms=latency_summary(first_event),
+        ready_event_ms=latency_summary(move_done),
+        timeouts=timeouts,
+    )
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _run(args) -> dict:
+    results = dict(
+        commit=_git_commit(),
+        timestamp=time.time(),
+        config=dict(
+            host=args.host,
+            port=args.port,
+            connections=args.connections,
+            depth=args.depth,
+            duration=args.duration,
+            mix=args.mix,
+        ),
+        load=await _run_load(args),
+    )
+
+    if args.motor_moves > 0:
+        results["motor_moves"] = await _run_motor_moves(args)
+
+    return results
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(_run(args))
+
+    text = json.dumps(results, indent=2)
+    if args.output is None:
+        sys.stdout.write(f"{text}\n")
+        return
+
+    with open(args.output, "w") as out:
+        out.write(f"{text}\n")
+
+
+if __name__ == "__main__":
+    main()
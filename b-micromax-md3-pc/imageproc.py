@@ -0,0 +1,163 @@
+"""
+video image post-processing, e.g. region of interest, binning and mono conversion
+
+All the processing is done with vectorized numpy operations. The processed
+images are kept in a bounded LRU cache, keyed by the source frame and
+the processing settings, so each source frame is processed once.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy
+
+# monochrome, 8-bit per pixel
+IMAGE_MODE_L = 0
+# rgb, 24-bit per pixel
+IMAGE_MODE_RGB = 6
+
+IMAGE_MODES = {"L": IMAGE_MODE_L, "RGB": IMAGE_MODE_RGB}
+BINNINGS = [1, 2, 4]
+
+# RGB to luminance conversion weights, in 1/256 units
+LUMINANCE_WEIGHTS = [77, 150, 29]
+
+# number of processed images to keep in the cache
+PROCESSED_CACHE_SIZE = 16
+
+
+@dataclass(frozen=True)
+class ImageSettings:
+    # region of interest, in source image pixels
+    roi_x: int
+    roi_y: int
+    roi_width: int
+    roi_height: int
+    binning: int = 1
+    mode: int = IMAGE_MODE_RGB
+
+    @property
+    def width(self) -> int:
+        return self.roi_width // self.binning
+
+    @property
+    def height(self) -> int:
+        return self.roi_height // self.binning
+
+    @property
+    def shape(self) -> tuple:
+        if self.mode == IMAGE_MODE_L:
+            return self.height, self.width
+
+        return self.height, self.width, 3
+
+    def is_identity(self, source_width: int, source_height: int) -> bool:
+        """
+        true if the settings do not modify source images
+        """
+        return (
+            (self.roi_x, self.roi_y) == (0, 0)
+            and (self.roi_width, self.roi_height) == (source_width, source_height)
+            and self.binning == 1
+            and self.mode == IMAGE_MODE_RGB
+        )
+
+
+def check_settings(settings: ImageSettings, source_width: int, source_height: int):
+    """
+    raise ValueError if the settings are not valid for the source image size
+    """
+    if settings.binning not in BINNINGS:
+        raise ValueError(
+            f"unsupported binning {settings.binning}, use one of {BINNINGS}"
+        )
+
+    if settings.mode not in IMAGE_MODES.values():
+        raise ValueError(f"unsupported image mode {settings.mode}")
+
+    if (
+        settings.roi_x < 0
+        or settings.roi_y < 0
+        or settings.roi_x + settings.roi_width > source_width
+        or settings.roi_y + settings.roi_height > source_height
+    ):
+        raise ValueError(f"ROI does not fit into {source_width}x{source_height} image")
+
+    if settings.width < 1 or settings.height < 1:
+        raise ValueError(
+            f"ROI {settings.roi_width}x{settings.roi_height} "
+            f"is too small for binning {settings.binning}"
+        )
+
+
+def to_luminance(pixels: numpy.ndarray) -> numpy.ndarray:
+    """
+    convert RGB pixels to 8-bit monochrome
+    """
+    luminance = numpy.zeros(pixels.shape[:2], numpy.uint16)
+    for channel, weight in enumerate(LUMINANCE_WEIGHTS):
+        luminance += pixels[..., channel].astype(numpy.uint16) * weight
+
+    return (luminance >> 8).astype(numpy.uint8)
+
+
+def bin_pixels(pixels: numpy.ndarray, binning: int) -> numpy.ndarray:
+    """
+    average each binning x binning pixels block
+    """
+    # sum up the blocks by adding strided views, one per pixel position in the block,
+    # 16-bit accumulator is enough for 4x4 blocks of 8-bit pixels
+    sums = numpy.zeros(pixels[::binning, ::binning].shape, numpy.uint16)
+    for row in range(binning):
+        for col in range(binning):
+            sums += pixels[row::binning, col::binning]
+
+    return (sums // (binning * binning)).astype(numpy.uint8)
+
+
+def process_image(pixels: numpy.ndarray, settings: ImageSettings) -> numpy.ndarray:
+    # crop the ROI, trimmed to a multiple of binning
+    height, width, binning = settings.height, settings.width, settings.binning
+    pixels = pixels[
+        settings.roi_y : settings.roi_y + height * binning,
+        settings.roi_x : settings.roi_x + width * binning,
+    ]
+
+    # convert to mono before binning, to have less data to bin
+    if settings.mode == IMAGE_MODE_L:
+        pixels = to_luminance(pixels)
+
+    if binning > 1:
+        pixels = bin_pixels(pixels, binning)
+
+    return numpy.ascontiguousarray(pixels)
+
+
+class ImageProcessor:
+    def __init__(self, cache_size: int = PROCESSED_CACHE_SIZE):
+        self._cache: OrderedDict[tuple, numpy.ndarray] = OrderedDict()
+        self._cache_size = cache_size
+
+    def process(
+        self, frame_key: tuple, pixels: numpy.ndarray, settings: ImageSettings
+    ) -> tuple[tuple, numpy.ndarray]:
+        """
+        apply settings to the source frame
+
+        returns the key identifying the processed image, and it's pixels
+        """
+        source_height, source_width = pixels.shape[:2]
+        if settings.is_identity(source_width, source_height):
+            # nothing to do, use the source image as is
+            return frame_key, pixels
+
+        key = (frame_key, settings)
+        image = self._cache.get(key)
+        if image is not None:
+            self._cache.move_to_end(key)
+            return key, image
+
+        image = process_image(pixels, settings)
+        self._cache[key] = image
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+        return key, image
@@ -0,0 +1,157 @@
+"""
+MD3 state shared between the exporter and the video camera emulators
+
+The exporter publishes the attributes the camera image depends on, i.e. motor
+positions, zoom and lights, in a small fixed-layout block of shared memory.
+The block is a memory-mapped file, named after the exporter's TCP port, so
+that each exporter instance has its own block.
+
+The block is a seqlock. The writer makes the sequence counter odd, writes
+the payload and makes the counter even again. The reader reads the counter,
+the payload and the counter again, and retries if the counter was odd or
+has changed, i.e. the reader never blocks the writer, and neither takes locks.
+
+The writer keeps the file when closed, and reuses it when restarted, thus
+the readers keep seeing the updates across exporter restarts.
+"""
+import os
+import mmap
+import struct
+import tempfile
+from typing import NamedTuple, Optional
+
+MAGIC = b"MD3STA1\n"
+# magic, sequence counter
+_HEADER = struct.Struct("<8sQ")
+_SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+# the fields of MD3State
+_PAYLOAD = struct.Struct("<dddddi??xxdd")
+
+BLOCK_SIZE = _HEADER.size + _PAYLOAD.size
+
+# max number of attempts to get a consistent read, before giving up,
+# e.g. when the writer was killed in the middle of an update
+MAX_READ_RETRIES = 1000
+
+STATE_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class MD3State(NamedTuple):
+    alignment_y: float = 0.0
+    alignment_z: float = 0.0
+    centring_x: float = 0.0
+    centring_y: float = 0.0
+    omega: float = 0.0
+    zoom: int = 1
+    front_light_is_on: bool = False
+    back_light_is_on: bool = False
+    front_light_factor: float = 0.0
+    back_light_factor: float = 0.0
+
+
+# exporter attribute, for each MD3State field
+STATE_ATTRIBUTES = [
+    "AlignmentYPosition",
+    "AlignmentZPosition",
+    "CentringXPosition",
+    "CentringYPosition",
+    "OmegaPosition",
+    "CoaxialCameraZoomValue",
+    "FrontLightIsOn",
+    "BackLightIsOn",
+    "FrontLightFactor",
+    "BackLightFactor",
+]
+
+
+def state_path(port: int) -> str:
+    return os.path.join(STATE_DIR, f"md3-state-{port}")
+
+
+class StateWriter:
+    def __init__(self, path: str):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, BLOCK_SIZE)
+            self._mmap = mmap.mmap(fd, BLOCK_SIZE)
+        finally:
+            os.close(fd)
+
+        # continue the sequence of a previous writer, if any,
+        # so that readers do not miss the first update
+        magic, sequence = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            sequence = 0
+        self._sequence = sequence + (sequence & 1)
+
+        _HEADER.pack_into(self._mmap, 0, MAGIC, self._sequence)
+
+    def update(self, attrs: dict):
+        """
+        publish the state from the exporter attributes
+        """
+        # odd sequence tells the readers an update is in progress
+        _SEQUENCE.pack_into(self._mmap, SEQUENCE_OFFSET, self._sequence + 1)
+        _PAYLOAD.pack_into(
+            self._mmap, _HEADER.size, *[attrs[name] for name in STATE_ATTRIBUTES]
+        )
+        self._sequence += 2
+        _SEQUENCE.pack_into(self._mmap, SEQUENCE_OFFSET, self._sequence)
+
+    def close(self):
+        self._mmap.close()
+
+
+class StateReader:
+    def __init__(self, path: str):
+        self._path = path
+        self._mmap: Optional[mmap.mmap] = None
+
+        # the last consistent read
+        self.sequence = 0
+        self.state = MD3State()
+
+    def _open(self) -> bool:
+        try:
+            fd = os.open(self._path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+
+        try:
+            if os.fstat(fd).st_size < BLOCK_SIZE:
+                # writer has not initialized the block yet
+                return False
+            self._mmap = mmap.mmap(fd, BLOCK_SIZE, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        return True
+
+    def read(self) -> MD3State:
+        """
+        get the latest published state
+
+        If the block does not exist yet, or the writer was not able to finish
+        an update, the last consistent state is returned.
+        """
+        if self._mmap is None and not self._open():
+            return self.state
+
+        buf = self._mmap
+        for _ in range(MAX_READ_RETRIES):
+            magic, sequence = _HEADER.unpack_from(buf, 0)
+            if magic != MAGIC or sequence & 1:
+                continue
+
+            if sequence == self.sequence:
+                # not changed since the last read
+                return self.state
+
+            payload = _PAYLOAD.unpack_from(buf, _HEADER.size)
+            if _SEQUENCE.unpack_from(buf, SEQUENCE_OFFSET)[0] == sequence:
+                self.sequence = sequence
+                self.state = MD3State(*payload)
+                break
+
+        return self.state
@@ -1,82 +1,624 @@
 #!/usr/bin/env python
+import os
+import sys
+import math
 import time
 import numpy
 import struct
-from pathlib import Path
+import dataclasses
+import traceback
 from random import random
-from tango.server import Device, attribute
-from simplejpeg import decode_jpeg
+from bisect import bisect_left
+from threading import Lock, Thread, Event
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from tango import EnsureOmniThread
+from tango.server import Device, attribute, command
+from simplejpeg import encode_jpeg
+from emulog import Logger
+from oavscene import SceneRenderer, SceneState
+from md3state import MD3State, StateReader, state_path
+from imageproc import (
+    IMAGE_MODE_L,
+    IMAGE_MODES,
+    ImageSettings,
+    ImageProcessor,
+    check_settings,
+    to_luminance,
+)
 
 CORNER_SIZE = 8
 
-# monochrome, 8-bit per pixel
-IMAGE_MODE_L = 0
-# rgb, 24-bit per pixel
-IMAGE_MODE_RGB = 6
-
-
-SAMPLE_JPEG = "sample.jpeg"
-IMAGE_MODE = IMAGE_MODE_RGB
+# full frame size
 WIDTH = 1224
 HEIGHT = 1024
 HEADER_SIZE = 32
-NUM_PIXELS = WIDTH * HEIGHT
 
+# video image header, the frame number field is updated for each frame
+_HEADER = struct.Struct(">IHHqiiHHxxxx")
+_FRAME_NUMBER = struct.Struct(">q")
+FRAME_NUMBER_OFFSET = 8
 
-def _paint_corner(orig, color):
-    pixels = numpy.copy(orig)
-    for i in range(CORNER_SIZE):
-        pixels[i][0:CORNER_SIZE] = color
+# frames cycle through variants of the scene image, with the top left
+# corner painted in these colors, None is the unmodified scene image
+CORNER_COLORS = [None, [0, 0, 0], [255, 0, 0], [0, 255, 0], [0, 0, 255]]
 
-    return bytearray(pixels)
+# number of frame buffers in the ring, per image variant
+RING_SLOTS_PER_VARIANT = 2
 
+# video_last_image formats, raw header + pixels image or JPEG compressed pixels
+FORMAT_RAW = "VIDEO_IMAGE"
+FORMAT_JPEG = "JPEG_RGB"
+# DevEncoded format of the JPEG compressed mono images
+FORMAT_JPEG_GRAY = "JPEG_GRAY8"
+DEFAULT_JPEG_QUALITY = 85
+# number of JPEG encoding worker threads
+JPEG_WORKERS = 2
+# max number of encoded JPEG images to keep
+JPEG_CACHE_SIZE = 64
 
-def _make_image(header, pixels, corner_color):
-    return header + _paint_corner(pixels, corner_color)
+# default frames per second produced
+FRAME_RATE = 25.0
+# sample period for achieved frame rate calculation, in seconds
+RATE_PERIOD = 1.0
+# upper bounds of the timing histograms buckets, in milliseconds,
+# the extra last bucket counts all the longer times
+HISTOGRAM_BOUNDS = [0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0]
+# max number of not yet sent video_last_image events per subscriber,
+# frames above this limit are dropped for slow subscribers, the drops happen
+# in the ZMQ event socket, and are not visible to the device
+EVENT_BUFFER_FRAMES = 4
 
+# MD3 exporter, that publishes the diffractometer state for the camera
+EXPORTER_PORT = 9001
+# light factor, that gives the full scene brightness
+FULL_LIGHT_FACTOR = 2.0
 
-def _load_images():
-    sample_pixels = decode_jpeg(Path(SAMPLE_JPEG).read_bytes())
+log = Logger.from_env(sys.stdout)
 
-    header = bytearray(
-        struct.pack(
-            ">IHHqiiHHxxxx", 1447314767, 1, IMAGE_MODE, 0, WIDTH, HEIGHT, 0, HEADER_SIZE
-        )
+
+def _light_level(is_on: bool, factor: float) -> float:
+    if not is_on:
+        return 0.0
+
+    return min(max(factor / FULL_LIGHT_FACTOR, 0.0), 1.0)
+
+
+def _scene_state(state: MD3State) -> SceneState:
+    return SceneState(
+        alignment_y=state.alignment_y,
+        alignment_z=state.alignment_z,
+        centring_x=state.centring_x,
+        centring_y=state.centring_y,
+        omega=state.omega,
+        zoom=state.zoom,
+        front_light=_light_level(state.front_light_is_on, state.front_light_factor),
+        back_light=_light_level(state.back_light_is_on, state.back_light_factor),
     )
 
-    yield header + bytearray(sample_pixels)
-    yield _make_image(header, sample_pixels, [0, 0, 0])
-    yield _make_image(header, sample_pixels, [255, 0, 0])
-    yield _make_image(header, sample_pixels, [0, 255, 0])
-    yield _make_image(header, sample_pixels, [0, 0, 255])
+
+def _make_header(settings: ImageSettings, frame_number: int = 0) -> bytes:
+    return _HEADER.pack(
+        1447314767,
+        1,
+        settings.mode,
+        frame_number,
+        settings.width,
+        settings.height,
+        0,
+        HEADER_SIZE,
+    )
+
+
+def _corner_colors(mode: int) -> list:
+    if mode != IMAGE_MODE_L:
+        return CORNER_COLORS
+
+    return [
+        None if color is None else to_luminance(numpy.array([[color]], numpy.uint8))
+        for color in CORNER_COLORS
+    ]
+
+
+class FrameRing:
+    """
+    preallocated ring of video image buffers
+
+    Each slot holds a complete video image, the header followed by the pixels.
+    Producing a frame patches the frame number in the header of the next slot,
+    and returns the slot buffer as is, without copying it. The pixels are only
+    copied into the slot when the slot holds a different scene frame, thus while
+    the scene does not change, producing a frame costs one header write.
+
+    The number of slots is a multiple of the number of image variants,
+    thus each slot always holds the same variant.
+
+    The ring is built for specific image settings, e.g. size and mode,
+    a new ring is created when the settings change.
+    """
+
+    def __init__(self, settings: ImageSettings, slots_per_variant: int):
+        self.settings = settings
+        self._corner_colors = _corner_colors(settings.mode)
+
+        shape = settings.shape
+        header = _make_header(settings)
+        self._slots = []
+        # numpy views of the slots pixels
+        self._pixels = []
+        # scene frame key of the pixels in each slot
+        self._frame_keys = []
+
+        for _ in range(len(CORNER_COLORS) * slots_per_variant):
+            slot = bytearray(HEADER_SIZE + math.prod(shape))
+            slot[:HEADER_SIZE] = header
+
+            pixels = numpy.frombuffer(slot, numpy.uint8, offset=HEADER_SIZE)
+
+            self._slots.append(slot)
+            self._pixels.append(pixels.reshape(shape))
+            self._frame_keys.append(None)
+
+    def get_frame(
+        self, frame_number: int, frame_key: tuple, scene_pixels: numpy.ndarray
+    ) -> tuple[bytearray, numpy.ndarray, tuple]:
+        """
+        get video image for the frame number, showing specified scene frame
+
+        returns the video image buffer, it's pixels and the key identifying
+        the pixels content, e.g. the scene frame and the corner color variant
+        """
+        idx = frame_number % len(self._slots)
+        variant = idx % len(CORNER_COLORS)
+        slot, pixels = self._slots[idx], self._pixels[idx]
+
+        if self._frame_keys[idx] != frame_key:
+            # paint the pixels in place, via the numpy view of the slot buffer
+            pixels[:] = scene_pixels
+            color = self._corner_colors[variant]
+            if color is not None:
+                pixels[:CORNER_SIZE, :CORNER_SIZE] = color
+
+            self._frame_keys[idx] = frame_key
+
+        _FRAME_NUMBER.pack_into(slot, FRAME_NUMBER_OFFSET, frame_number)
+
+        return slot, pixels, (frame_key, variant)
+
+
+class TimeHistogram:
+    def __init__(self, bounds: list[float] = HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    def add(self, seconds: float):
+        bucket = bisect_left(self.bounds, seconds * 1000.0)
+        with self._lock:
+            self.counts[bucket] += 1
+
+
+class JpegEncoder:
+    """
+    encodes frames to JPEG in worker threads, caching the encoded images
+
+    Each distinct frame content is encoded once for each quality level,
+    the following reads of the same frame get the cached JPEG bytes.
+    """
+
+    def __init__(self, workers: int = JPEG_WORKERS, cache_size: int = JPEG_CACHE_SIZE):
+        # time spent encoding each image
+        self.encode_times = TimeHistogram()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="jpeg")
+        self._cache_size = cache_size
+        # (frame content key, quality) -> future JPEG bytes, least recently used first
+        self._cache: OrderedDict[tuple, Future] = OrderedDict()
+        self._lock = Lock()
+
+    def _get_future(self, key, pixels: numpy.ndarray, quality: int) -> Future:
+        with self._lock:
+            cache_key = (key, quality)
+            future = self._cache.get(cache_key)
+            if future is not None:
+                self._cache.move_to_end(cache_key)
+                return future
+
+            if pixels.ndim == 2:
+                # monochrome image, encoder expects a channels axis
+                pixels = pixels[..., numpy.newaxis]
+                colorspace, subsampling = "GRAY", "Gray"
+            else:
+                colorspace, subsampling = "RGB", "444"
+
+            future = self._executor.submit(
+                self._encode,
+                pixels,
+                quality=quality,
+                colorspace=colorspace,
+                colorsubsampling=subsampling,
+            )
+            self._cache[cache_key] = future
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+            return future
+
+    def _encode(self, pixels: numpy.ndarray, **kwargs) -> bytes:
+        start = time.perf_counter()
+        jpeg = encode_jpeg(pixels, **kwargs)
+        self.encode_times.add(time.perf_counter() - start)
+
+        return jpeg
+
+    def encode(self, key, pixels: numpy.ndarray, quality: int) -> bytes:
+        return self._get_future(key, pixels, quality).result()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RateMeter:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # (time, count) samples, for rate calculation
+        self._prev_sample = self._last_sample = (time.monotonic(), 0)
+
+    def rate(self, count: int) -> float:
+        """
+        counts per second, averaged over last sampling period
+        """
+        now = time.monotonic()
+        if now - self._last_sample[0] >= RATE_PERIOD:
+            self._prev_sample = self._last_sample
+            self._last_sample = (now, count)
+
+        (prev_time, prev_count), (last_time, last_count) = (
+            self._prev_sample,
+            self._last_sample,
+        )
+        if last_time == prev_time:
+            return 0.0
+
+        return (last_count - prev_count) / (last_time - prev_time)
+
+
+class ProducerStats:
+    def __init__(self):
+        self._rate = RateMeter()
+        # time spent producing each frame, not including JPEG encoding
+        self.generation_times = TimeHistogram()
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        # frames skipped because the producer fell behind the frame rate
+        self.late_frames = 0
+        self._rate.reset()
+        self.generation_times.reset()
+
+    @property
+    def frames_per_second(self) -> float:
+        return self._rate.rate(self.frames)
+
+
+class ServingStats:
+    """
+    statistics of the frames handed over to Tango, i.e. read or pushed as events
+    """
+
+    def __init__(self):
+        self._reads_rate = RateMeter()
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.bytes = 0
+        self.reads = 0
+        # milliseconds since the production of the last read frame
+        self.frame_age = 0.0
+        self._reads_rate.reset()
+
+    def served(self, image: tuple[str, bytes]):
+        self.frames += 1
+        self.bytes += len(image[1])
+
+    def read(self, image: tuple[str, bytes], produced: float):
+        self.served(image)
+        self.reads += 1
+        self.frame_age = (time.monotonic() - produced) * 1000.0
+
+    @property
+    def reads_per_second(self) -> float:
+        return self._reads_rate.rate(self.reads)
 
 
 class MD3(Device):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._images = list(_load_images())
+    def init_device(self):
+        """
+        set up the device, also invoked by the Init command, after delete_device()
+        """
+        super().init_device()
+        self._scene = SceneRenderer(WIDTH, HEIGHT)
+        # diffractometer state, published by the exporter
+        self._md3_state = StateReader(state_path(EXPORTER_PORT))
+        self._scene_state = SceneState()
+        # until the exporter publishes its state, show the fully lit scene
+        self._scene_state_sequence = 0
+        self._processor = ImageProcessor()
+        self._frames = FrameRing(
+            ImageSettings(0, 0, WIDTH, HEIGHT), RING_SLOTS_PER_VARIANT
+        )
         self._frame_number = 0
 
-    def _get_image(self):
-        self._frame_number += 1
-        image = self._images[self._frame_number % len(self._images)]
-        # update frame number in the header
-        image[8:16] = struct.pack(">q", self._frame_number)
+        self._jpeg_encoder = JpegEncoder()
+        self._image_format = FORMAT_RAW
+        self._jpeg_quality = DEFAULT_JPEG_QUALITY
 
-        return image
+        self._producer_stats = ProducerStats()
+        self._serving_stats = ServingStats()
+
+        # the most recently produced video image, as (production time, image),
+        # the image header has no timestamp, so production time is kept here
+        self._last_frame = self._produce_frame(self._frame_number)
+
+        self._frame_rate = FRAME_RATE
+        self.set_change_event("video_last_image", True, False)
+
+        self._stop_producer = Event()
+        self._producer = Thread(target=self._run_producer, daemon=True)
+        self._producer.start()
+
+    def delete_device(self):
+        if self._producer.is_alive():
+            self._stop_producer.set()
+            self._producer.join()
+
+        self._jpeg_encoder.close()
+
+    def _get_scene_state(self) -> SceneState:
+        md3_state = self._md3_state.read()
+        if self._md3_state.sequence != self._scene_state_sequence:
+            self._scene_state = _scene_state(md3_state)
+            self._scene_state_sequence = self._md3_state.sequence
+
+        return self._scene_state
+
+    def _get_image(self, frame_number: int) -> tuple[str, bytes]:
+        # the ring can be replaced by attribute writes, make sure we use the same one
+        frames = self._frames
+        start = time.perf_counter()
+
+        frame_key, scene_pixels = self._scene.render(self._get_scene_state())
+        frame_key, frame_pixels = self._processor.process(
+            frame_key, scene_pixels, frames.settings
+        )
+        image, pixels, content_key = frames.get_frame(
+            frame_number, frame_key, frame_pixels
+        )
+        self._producer_stats.generation_times.add(time.perf_counter() - start)
+
+        if self._image_format == FORMAT_JPEG:
+            jpeg = self._jpeg_encoder.encode(content_key, pixels, self._jpeg_quality)
+            if frames.settings.mode == IMAGE_MODE_L:
+                return FORMAT_JPEG_GRAY, jpeg
+
+            return FORMAT_JPEG, jpeg
+
+        return FORMAT_RAW, image
+
+    def _produce_frame(self, frame_number: int) -> tuple[float, tuple[str, bytes]]:
+        image = self._get_image(frame_number)
+        return time.monotonic(), image
+
+    def _push_frame(self, frame_number: int):
+        self._last_frame = self._produce_frame(frame_number)
+        image = self._last_frame[1]
+        self.push_change_event("video_last_image", *image)
+        self._serving_stats.served(image)
+        self._producer_stats.frames += 1
+
+    def _run_producer(self):
+        """
+        produce frames at the configured frame rate, and push them as change events
+        """
+        stats = self._producer_stats
+
+        with EnsureOmniThread():
+            next_frame = time.monotonic()
+            while not self._stop_producer.is_set():
+                self._frame_number += 1
+                try:
+                    self._push_frame(self._frame_number)
+                except Exception:
+                    # keep the video going, the next frame may succeed
+                    log.error(
+                        f"failed to produce frame {self._frame_number}\n"
+                        f"{traceback.format_exc()}"
+                    )
+
+                period = 1.0 / self._frame_rate
+                next_frame += period
+                now = time.monotonic()
+                if now > next_frame:
+                    # we are late, skip the frames we did not have time to produce
+                    missed = int((now - next_frame) / period) + 1
+                    self._frame_number += missed
+                    stats.late_frames += missed
+                    next_frame += missed * period
+
+                self._stop_producer.wait(next_frame - now)
 
     @attribute(dtype="DevEncoded", format="%d")
     def video_last_image(self):
-        return "VIDEO_IMAGE", self._get_image()
+        produced, image = self._last_frame
+        self._serving_stats.read(image, produced)
+
+        return image
+
+    @attribute(dtype="DevDouble", unit="Hz", min_value=0.1, max_value=200.0)
+    def frame_rate(self):
+        return self._frame_rate
+
+    @frame_rate.write
+    def frame_rate(self, frame_rate: float):
+        self._frame_rate = frame_rate
+
+    @attribute(dtype="DevDouble", unit="Hz")
+    def achieved_frame_rate(self):
+        return self._producer_stats.frames_per_second
+
+    @attribute(dtype="DevULong64")
+    def late_frames(self):
+        """
+        number of frames not produced, because producing the previous frames
+        took longer than the frame period
+
+        This is not the number of frames dropped for slow event subscribers,
+        those are dropped by ZMQ and can't be counted by the device.
+        """
+        return self._producer_stats.late_frames
+
+    @attribute(dtype="DevString")
+    def image_format(self):
+        """
+        JPEG_RGB selects JPEG images, which are served as JPEG_GRAY8 in mono mode
+        """
+        return self._image_format
+
+    @image_format.write
+    def image_format(self, image_format: str):
+        if image_format not in (FORMAT_RAW, FORMAT_JPEG):
+            raise ValueError(
+                f"unsupported image format '{image_format}', "
+                f"use {FORMAT_RAW} or {FORMAT_JPEG}"
+            )
+
+        self._image_format = image_format
+
+    @attribute(dtype="DevLong", min_value=1, max_value=100)
+    def jpeg_quality(self):
+        return self._jpeg_quality
+
+    @jpeg_quality.write
+    def jpeg_quality(self, quality: int):
+        self._jpeg_quality = quality
+
+    def _change_settings(self, **changes):
+        settings = dataclasses.replace(self._frames.settings, **changes)
+        check_settings(settings, WIDTH, HEIGHT)
+
+        self._frames = FrameRing(settings, RING_SLOTS_PER_VARIANT)
+
+    @attribute(dtype=(int,), max_dim_x=4)
+    def image_roi(self):
+        settings = self._frames.settings
+        return [
+            settings.roi_x,
+            settings.roi_y,
+            settings.roi_width,
+            settings.roi_height,
+        ]
+
+    @image_roi.write
+    def image_roi(self, roi):
+        """
+        set region of interest as [x, y, width, height],
+        [0, 0, 0, 0] resets to the full frame
+        """
+        if len(roi) != 4:
+            raise ValueError("expected ROI as [x, y, width, height]")
+
+        x, y, width, height = [int(v) for v in roi]
+        if width == 0 and height == 0:
+            x, y, width, height = 0, 0, WIDTH, HEIGHT
+
+        self._change_settings(roi_x=x, roi_y=y, roi_width=width, roi_height=height)
+
+    @attribute(dtype="DevLong")
+    def image_binning(self):
+        return self._frames.settings.binning
+
+    @image_binning.write
+    def image_binning(self, binning: int):
+        self._change_settings(binning=binning)
+
+    @attribute(dtype="DevString")
+    def image_mode(self):
+        mode = self._frames.settings.mode
+        return next(name for name, val in IMAGE_MODES.items() if val == mode)
+
+    @image_mode.write
+    def image_mode(self, mode_name: str):
+        mode = IMAGE_MODES.get(mode_name)
+        if mode is None:
+            raise ValueError(
+                f"unsupported image mode '{mode_name}', use one of {list(IMAGE_MODES)}"
+            )
+
+        self._change_settings(mode=mode)
 
     @attribute(dtype="DevULong")
     def image_width(self):
-        return WIDTH
+        return self._frames.settings.width
 
     @attribute(dtype="DevULong")
     def image_height(self):
-        return HEIGHT
+        return self._frames.settings.height
+
+    @attribute(dtype="DevULong64")
+    def frames_served(self):
+        """
+        number of frames read or pushed as change events
+        """
+        return self._serving_stats.frames
+
+    @attribute(dtype="DevULong64", unit="B")
+    def bytes_served(self):
+        return self._serving_stats.bytes
+
+    @attribute(dtype="DevDouble", unit="Hz")
+    def reads_per_second(self):
+        return self._serving_stats.reads_per_second
+
+    @attribute(dtype="DevDouble", unit="ms")
+    def frame_age(self):
+        """
+        age of the last read frame, when it was read
+        """
+        return self._serving_stats.frame_age
+
+    @attribute(dtype=(float,), max_dim_x=len(HISTOGRAM_BOUNDS), unit="ms")
+    def histogram_bounds(self):
+        """
+        upper bounds of the timing histograms buckets
+        """
+        return HISTOGRAM_BOUNDS
+
+    @attribute(dtype=(int,), max_dim_x=len(HISTOGRAM_BOUNDS) + 1)
+    def generation_time_histogram(self):
+        return self._producer_stats.generation_times.counts
+
+    @attribute(dtype=(int,), max_dim_x=len(HISTOGRAM_BOUNDS) + 1)
+    def encode_time_histogram(self):
+        return self._jpeg_encoder.encode_times.counts
+
+    @command
+    def ResetCounters(self):
+        """
+        reset all the statistics, e.g. at the start of a benchmark
+        """
+        self._producer_stats.reset()
+        self._serving_stats.reset()
+        self._jpeg_encoder.encode_times.reset()
 
 
 if __name__ == "__main__":
+    # keep only a few frames queued for each event subscriber, so that
+    # slow subscribers have frames dropped, instead of falling behind
+    os.environ.setdefault("TANGO_DS_EVENT_BUFFER_HWM", str(EVENT_BUFFER_FRAMES))
     MD3.run_server()
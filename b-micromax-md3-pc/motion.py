@@ -0,0 +1,128 @@
+"""
+MD3Up motors motion emulation
+
+All motors are advanced together on each tick, with positions, velocities and
+targets stored in numpy arrays. Motors move with trapezoidal velocity profiles,
+e.g. accelerate to max velocity, cruise and decelerate to a stop at target.
+"""
+from dataclasses import dataclass
+import numpy
+
+
+@dataclass
+class MotorSpec:
+    low_limit: float
+    high_limit: float
+    # in motor units per second
+    velocity: float
+    # in motor units per second squared
+    acceleration: float
+    # rotation motor, position is wrapped within 0..360 degrees range
+    wraps: bool = False
+
+
+class MotionEngine:
+    def __init__(self, motors: dict[str, MotorSpec], positions: dict[str, float]):
+        self._names = list(motors.keys())
+        self._indices = {name: idx for idx, name in enumerate(self._names)}
+
+        def array(vals, dtype=float):
+            return numpy.array(list(vals), dtype=dtype)
+
+        specs = motors.values()
+        self._low = array(spec.low_limit for spec in specs)
+        self._high = array(spec.high_limit for spec in specs)
+        self._max_vel = array(spec.velocity for spec in specs)
+        self._accel = array(spec.acceleration for spec in specs)
+        self._wraps = array((spec.wraps for spec in specs), bool)
+
+        self._pos = array(positions[name] for name in self._names)
+        self._target = self._pos.copy()
+        self._vel = numpy.zeros(len(self._names))
+        self._moving = numpy.zeros(len(self._names), bool)
+
+    def move(self, motor_name: str, target: float):
+        """
+        start moving the motor to new position
+
+        If the motor is already moving, it will be re-targeted on the next tick.
+        """
+        idx = self._indices[motor_name]
+
+        if not self._wraps[idx]:
+            target = min(max(target, self._low[idx]), self._high[idx])
+
+        self._target[idx] = target
+        self._moving[idx] = True
+
+    def set_position(self, motor_name: str, position: float):
+        """
+        place the motor at the position right away, stopping it if moving
+        """
+        idx = self._indices[motor_name]
+
+        self._pos[idx] = self._target[idx] = position
+        self._vel[idx] = 0.0
+        self._moving[idx] = False
+
+    def abort(self):
+        """
+        stop all motors on the next tick
+        """
+        self._target[self._moving] = self._pos[self._moving]
+        self._vel[:] = 0.0
+
+    def is_moving(self) -> bool:
+        return bool(self._moving.any())
+
+    def _reported_positions(self, indices) -> numpy.ndarray:
+        pos = self._pos[indices]
+        return numpy.where(self._wraps[indices], pos % 360.0, pos)
+
+    def tick(self, dt: float) -> list[tuple[str, str, float]]:
+        """
+        advance all moving motors by dt seconds
+
+        returns list of (motor name, state, position) tuples for motors
+        that were moving during this tick
+        """
+        moving = self._moving
+        if not moving.any():
+            return []
+
+        remaining = self._target - self._pos
+        direction = numpy.where(remaining < 0.0, -1.0, 1.0)
+        distance = numpy.abs(remaining)
+
+        #
+        # trapezoidal profile: accelerate towards max velocity,
+        # but not faster than allows to brake to a stop at the target
+        #
+        braking_vel = numpy.sqrt(2.0 * self._accel * distance)
+        wanted_vel = numpy.minimum(self._max_vel, braking_vel)
+        # current velocity towards the target, negative if re-targeted
+        # to the opposite direction while moving
+        current_vel = self._vel * direction
+        dv = self._accel * dt
+        vel = numpy.clip(wanted_vel, current_vel - dv, current_vel + dv)
+
+        step = vel * dt
+        arrived = moving & (step >= distance)
+
+        self._pos = numpy.where(moving, self._pos + direction * step, self._pos)
+        self._pos[arrived] = self._target[arrived]
+        self._vel = numpy.where(moving & ~arrived, vel * direction, 0.0)
+
+        # keep rotation motors positions within 0..360 degrees once they stop
+        wrap = arrived & self._wraps
+        self._pos[wrap] %= 360.0
+        self._target[wrap] = self._pos[wrap]
+
+        indices = numpy.flatnonzero(moving)
+        positions = self._reported_positions(indices)
+        self._moving = moving & ~arrived
+
+        return [
+            (self._names[idx], "Ready" if arrived[idx] else "Moving", float(pos))
+            for idx, pos in zip(indices, positions)
+        ]
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Run multiple emulated MD3Up exporters.
+
+Starts a number of independent MD3Up exporter instances, listening on
+consecutive TCP ports. The instances are spread over a pool of worker processes,
+each worker process runs one event loop serving its share of instances.
+
+The launcher supervises the workers. A worker process that dies is restarted,
+with an exponentially growing delay between consecutive restarts. After too many
+consecutive restarts, e.g. when a port can't be bound, the worker is given up.
+The workers periodically report the load of each of their instances,
+the handled messages rate and TCP server statistics, which is logged by the launcher.
+"""
+import os
+import sys
+import time
+import asyncio
+import multiprocessing
+from queue import Empty
+from argparse import ArgumentParser
+from typing import Optional
+from multiprocessing.process import BaseProcess
+from atcpserv import AsyncTCPServer, run_event_loop
+from emulog import Logger
+from exporter import Exporter, PORT, create_server
+from capture import open_capture_from_env
+from md3state import StateWriter, state_path
+
+# how often workers report the instances load, in seconds
+REPORT_INTERVAL = 10.0
+# delay before restarting a dead worker, doubled with each consecutive restart
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+# max number of consecutive restarts of a worker, before giving up
+MAX_RESTARTS = 10
+# worker that has been running for this many seconds is considered healthy,
+# and its consecutive restarts count starts from zero
+STABLE_RUN_TIME = 60.0
+
+log = Logger.from_env(sys.stdout)
+
+
+def parse_args():
+    parser = ArgumentParser(description="Run multiple MD3Up exporter emulators")
+
+    parser.add_argument(
+        "-n",
+        "--instances",
+        type=int,
+        default=4,
+        help="number of MD3Up instances to run",
+    )
+
+    parser.add_argument(
+        "-p",
+        "--base-port",
+        type=int,
+        default=PORT,
+        help="TCP port of the first instance, the rest use consecutive ports",
+    )
+
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="max number of worker processes",
+    )
+
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=REPORT_INTERVAL,
+        help="seconds between instances load reports",
+    )
+
+    return parser.parse_args()
+
+
+async def _report_load(
+    ports: list[int],
+    exporters: list[Exporter],
+    servers: list[AsyncTCPServer],
+    stats_queue: multiprocessing.Queue,
+    interval: float,
+):
+    last_handled = [0] * len(exporters)
+    last_time = time.monotonic()
+
+    while True:
+        await asyncio.sleep(interval)
+
+        now = time.monotonic()
+        elapsed = now - last_time
+        last_time = now
+
+        load = []
+        for n, (port, exporter, server) in enumerate(zip(ports, exporters, servers)):
+            handled = exporter.messages_handled
+            rate = (handled - last_handled[n]) / elapsed
+            last_handled[n] = handled
+            load.append((port, rate, str(server.stats)))
+
+        stats_queue.put((os.getpid(), load))
+
+
+async def _serve(
+    ports: list[int], stats_queue: multiprocessing.Queue, report_interval: float
+):
+    captures = [open_capture_from_env(port) for port in ports]
+    states = [StateWriter(state_path(port)) for port in ports]
+    exporters = [
+        Exporter(f"MD3:{port}", capture, state)
+        for port, capture, state in zip(ports, captures, states)
+    ]
+    servers = [
+        create_server(port, exporter) for port, exporter in zip(ports, exporters)
+    ]
+
+    try:
+        await asyncio.gather(
+            _report_load(ports, exporters, servers, stats_queue, report_interval),
+            *[server.serve() for server in servers],
+        )
+    finally:
+        for state in states:
+            state.close()
+        for capture in captures:
+            if capture is not None:
+                capture.close()
+
+
+def _run_worker(
+    ports: list[int], stats_queue: multiprocessing.Queue, report_interval: float
+):
+    log.info(f"worker {os.getpid()} serving MD3 instances on ports {ports}")
+    try:
+        run_event_loop(_serve(ports, stats_queue, report_interval))
+    except KeyboardInterrupt:
+        # just exit without any fuss
+        pass
+
+
+def _split_ports(base_port: int, instances: int, workers: int) -> list[list[int]]:
+    """
+    spread instances ports evenly over workers
+    """
+    ports = list(range(base_port, base_port + instances))
+    workers = max(1, min(workers, instances))
+
+    return [ports[n::workers] for n in range(workers)]
+
+
+class Launcher:
+    def __init__(self, shards: list[list[int]], report_interval: float):
+        # use 'spawn', so that worker processes get a clean copy of the
+        # exporter module, e.g. without any inherited logger flusher state
+        self._mp = multiprocessing.get_context("spawn")
+        self._stats_queue = self._mp.Queue()
+        self._report_interval = report_interval
+
+        self._shards = shards
+        # None, if the worker was given up
+        self._workers: list[Optional[BaseProcess]] = [None] * len(shards)
+        # worker's start time, and the number of consecutive restarts
+        self._started = [0.0] * len(shards)
+        self._restarts = [0] * len(shards)
+        # when to restart a dead worker, None if the worker is alive
+        self._restart_at: list[Optional[float]] = [None] * len(shards)
+
+    def _start_worker(self, shard: int):
+        worker = self._mp.Process(
+            target=_run_worker,
+            args=(self._shards[shard], self._stats_queue, self._report_interval),
+            daemon=True,
+        )
+        worker.start()
+        self._workers[shard] = worker
+        self._started[shard] = time.monotonic()
+
+    def _worker_died(self, shard: int, worker: BaseProcess):
+        now = time.monotonic()
+        if now - self._started[shard] >= STABLE_RUN_TIME:
+            self._restarts[shard] = 0
+
+        died = (
+            f"worker {worker.pid} serving ports {self._shards[shard]} "
+            f"died with exit code {worker.exitcode}"
+        )
+        if self._restarts[shard] >= MAX_RESTARTS:
+            log.error(f"{died}, restarted {MAX_RESTARTS} times, giving up")
+            self._workers[shard] = None
+            return
+
+        delay = min(RESTART_DELAY * 2 ** self._restarts[shard], MAX_RESTART_DELAY)
+        log.warning(f"{died}, restarting in {delay:.1f} seconds")
+        self._restart_at[shard] = now + delay
+
+    def _restart_dead_workers(self):
+        for shard, worker in enumerate(self._workers):
+            if worker is None or worker.is_alive():
+                continue
+
+            if self._restart_at[shard] is None:
+                self._worker_died(shard, worker)
+            elif time.monotonic() >= self._restart_at[shard]:
+                self._restart_at[shard] = None
+                self._restarts[shard] += 1
+                self._start_worker(shard)
+
+    def _all_given_up(self) -> bool:
+        return all(worker is None for worker in self._workers)
+
+    def _log_load(self, pid: int, load: list):
+        lines = [f"worker {pid} load:"]
+        for port, rate, server_stats in load:
+            lines.append(f"  port {port}: {rate:.1f} messages/s, {server_stats}")
+
+        log.info("\n".join(lines))
+
+    def run(self):
+        for shard in range(len(self._shards)):
+            self._start_worker(shard)
+
+        while True:
+            try:
+                pid, load = self._stats_queue.get(timeout=1.0)
+                self._log_load(pid, load)
+            except Empty:
+                pass
+
+            self._restart_dead_workers()
+            if self._all_given_up():
+                log.error("all workers have been given up, exiting")
+                return
+
+
+def main():
+    args = parse_args()
+    shards = _split_ports(args.base_port, args.instances, args.workers)
+
+    log.info(
+        f"starting {args.instances} MD3 exporter emulators on ports "
+        f"{args.base_port}-{args.base_port + args.instances - 1}, "
+        f"using {len(shards)} worker processes"
+    )
+
+    try:
+        Launcher(shards, args.report_interval).run()
+    except KeyboardInterrupt:
+        # just exit without any fuss
+        pass
+
+
+if __name__ == "__main__":
+    main()
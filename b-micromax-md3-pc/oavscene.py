@@ -0,0 +1,179 @@
+"""
+synthetic on-axis video (OAV) camera scene
+
+Renders a sample loop on a pin, as seen by the MD3 on-axis camera, for
+the current diffractometer motor positions, camera zoom and lights. The image
+is rendered with vectorized numpy operations.
+
+The horizontal image axis is the omega rotation axis, moved by AlignmentY.
+The loop is moved vertically by AlignmentZ and by the centring table,
+i.e. CentringX and CentringY, projected according to the omega angle.
+Omega rotates the loop plane, thus the loop is seen face-on at 0 and 180
+degrees, and edge-on at 90 and 270 degrees. With the motors at zero, the loop
+is in the center of the image.
+
+The back light illuminates the background, the front light illuminates
+the sample. With the lights off, the scene is only dimly lit by the ambient
+light.
+
+Rendered frames are kept in a bounded LRU cache, keyed by the scene state
+quantized to the image resolution, so that as long as the sample does not
+move, the frame is only rendered once.
+"""
+import math
+from collections import OrderedDict
+from dataclasses import dataclass
+import numpy
+
+# mm per pixel, at the lowest zoom level
+PIXEL_SIZE = 0.0018851562499999997
+# magnification of each CoaxialCameraZoomValue zoom level, starting with level 1
+ZOOM_MAGNIFICATIONS = [1.0, 1.4, 2.0, 2.8, 4.0, 5.6, 8.0]
+# omega angle step of rendered frames, in degrees
+OMEGA_QUANTUM = 0.5
+# step of rendered light levels
+LIGHT_QUANTUM = 1.0 / 32
+# brightness of the scene with the lights off, relative to full light
+AMBIENT_LIGHT = 0.25
+
+# sample dimensions, in mm
+LOOP_RADIUS = 0.2
+LOOP_WIRE_WIDTH = 0.012
+PIN_RADIUS = 0.025
+CRYSTAL_RADIUS = 0.06
+
+# RGB colors
+BACKGROUND_TOP = [208, 214, 222]
+BACKGROUND_BOTTOM = [150, 160, 176]
+LOOP_COLOR = [40, 40, 48]
+PIN_COLOR = [96, 96, 104]
+CRYSTAL_COLOR = [182, 196, 92]
+
+# number of rendered frames to keep in the cache
+RENDER_CACHE_SIZE = 16
+
+
+@dataclass(frozen=True)
+class SceneState:
+    alignment_y: float = 0.0
+    alignment_z: float = 0.0
+    centring_x: float = 0.0
+    centring_y: float = 0.0
+    omega: float = 0.0
+    zoom: int = 1
+    # light levels, from 0.0 for off to 1.0 for full light
+    front_light: float = 1.0
+    back_light: float = 1.0
+
+
+def _magnification(zoom: int) -> float:
+    level = min(max(zoom, 1), len(ZOOM_MAGNIFICATIONS))
+    return ZOOM_MAGNIFICATIONS[level - 1]
+
+
+def _brightness(light_step: int) -> float:
+    light = min(light_step * LIGHT_QUANTUM, 1.0)
+    return AMBIENT_LIGHT + (1.0 - AMBIENT_LIGHT) * light
+
+
+class SceneRenderer:
+    def __init__(self, width: int, height: int, cache_size: int = RENDER_CACHE_SIZE):
+        self._width = width
+        self._height = height
+
+        # pixel coordinates, relative to the image center
+        self._xs = numpy.arange(width, dtype=numpy.float32) - width / 2.0
+        self._ys = numpy.arange(height, dtype=numpy.float32) - height / 2.0
+
+        # vertical gradient background
+        blend = numpy.linspace(0.0, 1.0, height, dtype=numpy.float32)[:, None]
+        top = numpy.array(BACKGROUND_TOP, numpy.float32)
+        bottom = numpy.array(BACKGROUND_BOTTOM, numpy.float32)
+        self._row_colors = top + (bottom - top) * blend
+
+        self._cache: OrderedDict[tuple, numpy.ndarray] = OrderedDict()
+        self._cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def frame_key(self, state: SceneState) -> tuple:
+        """
+        the state quantized to the rendered image resolution,
+        states with the same key produce the same image
+        """
+        pixel_size = PIXEL_SIZE / _magnification(state.zoom)
+
+        omega = math.radians(state.omega)
+        vertical = (
+            state.alignment_z
+            + state.centring_x * math.sin(omega)
+            + state.centring_y * math.cos(omega)
+        )
+
+        return (
+            state.zoom,
+            round(-state.alignment_y / pixel_size),
+            round(vertical / pixel_size),
+            round((state.omega % 360.0) / OMEGA_QUANTUM),
+            round(state.front_light / LIGHT_QUANTUM),
+            round(state.back_light / LIGHT_QUANTUM),
+        )
+
+    def _render(self, key: tuple) -> numpy.ndarray:
+        zoom, x_offset, y_offset, omega_step, front_step, back_step = key
+        pixel_size = PIXEL_SIZE / _magnification(zoom)
+        omega = math.radians(omega_step * OMEGA_QUANTUM)
+
+        # pixel coordinates in mm, relative to the loop center
+        us = (self._xs - x_offset) * pixel_size
+        vs = (self._ys - y_offset) * pixel_size
+
+        # loop is an ellipse, flattened as the loop plane rotates
+        loop_height = max(LOOP_RADIUS * abs(math.cos(omega)), LOOP_WIRE_WIDTH)
+        radius = numpy.sqrt(
+            (us / LOOP_RADIUS)[None, :] ** 2 + (vs / loop_height)[:, None] ** 2
+        )
+        wire = LOOP_WIRE_WIDTH / LOOP_RADIUS
+        loop = numpy.abs(radius - 1.0) < wire
+
+        # pin holds the loop from the right side of the image
+        pin = (us > LOOP_RADIUS)[None, :] & (numpy.abs(vs) < PIN_RADIUS)[:, None]
+
+        # crystal sits inside the loop, its thickness varies with the rotation
+        crystal_height = CRYSTAL_RADIUS * (0.4 + 0.6 * abs(math.sin(omega + 0.5)))
+        crystal = (
+            (us / CRYSTAL_RADIUS)[None, :] ** 2 + (vs / crystal_height)[:, None] ** 2
+        ) < 1.0
+
+        row_colors = (self._row_colors * _brightness(back_step)).astype(numpy.uint8)
+        image = numpy.repeat(row_colors[:, None, :], self._width, axis=1)
+
+        front = _brightness(front_step)
+        for mask, color in (
+            (pin, PIN_COLOR),
+            (crystal, CRYSTAL_COLOR),
+            (loop, LOOP_COLOR),
+        ):
+            image[mask] = [int(c * front) for c in color]
+
+        return image
+
+    def render(self, state: SceneState) -> tuple[tuple, numpy.ndarray]:
+        """
+        get the image for the scene state, and its frame key
+        """
+        key = self.frame_key(state)
+
+        image = self._cache.get(key)
+        if image is not None:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return key, image
+
+        self.cache_misses += 1
+        image = self._render(key)
+        self._cache[key] = image
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+        return key, image
@@ -0,0 +1,103 @@
+"""
+MD3Up raster scan emulation
+
+The whole grid trajectory is computed up front, as a numpy array of motor
+positions, indexed by motor, line and frame. The grid is centred on the motor
+positions at the start of the scan. Lines are scanned vertically, and the
+scan steps horizontally between the lines.
+
+The vertical axis is the centring table, i.e. CentringX and CentringY motors,
+oriented according to the current omega angle, or AlignmentZ motor, if centring
+table is not used. The horizontal axis is AlignmentY motor.
+
+Each line takes ScanExposureTime seconds. The motor positions are reported
+once per line, when the line is completed, so that the number of reported
+events does not depend on the number of frames.
+"""
+import math
+import numpy
+
+HORIZONTAL_MOTOR = "AlignmentY"
+VERTICAL_MOTOR = "AlignmentZ"
+
+
+def _offsets(scan_range: float, num_frames: int) -> numpy.ndarray:
+    """
+    evenly spaced offsets, centred on zero
+    """
+    step = scan_range / max(num_frames - 1, 1)
+    return (numpy.arange(num_frames) - (num_frames - 1) / 2.0) * step
+
+
+class RasterScan:
+    def __init__(
+        self,
+        start_positions: dict[str, float],
+        omega: float,
+        vertical_range: float,
+        horizontal_range: float,
+        vert_num_frames: int,
+        horiz_num_frames: int,
+        enable_reverse_direction: bool,
+        use_centring_table: bool,
+        line_time: float,
+        start_time: float,
+    ):
+        num_lines = horiz_num_frames
+
+        # vertical offsets, one row per line
+        line = _offsets(vertical_range, vert_num_frames)
+        vertical = numpy.tile(line, (num_lines, 1))
+        if enable_reverse_direction:
+            # scan every other line in opposite direction
+            vertical[1::2] = vertical[1::2, ::-1]
+
+        # horizontal offsets, the same for all frames of a line
+        horizontal = numpy.repeat(
+            _offsets(horizontal_range, num_lines)[:, numpy.newaxis],
+            vert_num_frames,
+            axis=1,
+        )
+
+        offsets = {HORIZONTAL_MOTOR: horizontal}
+        if use_centring_table:
+            omega = math.radians(omega)
+            offsets["CentringX"] = vertical * math.sin(omega)
+            offsets["CentringY"] = vertical * math.cos(omega)
+        else:
+            offsets[VERTICAL_MOTOR] = vertical
+
+        self.motors = list(offsets.keys())
+        self._positions = numpy.stack(
+            [start_positions[motor] + offsets[motor] for motor in self.motors]
+        )
+
+        self._num_lines = num_lines
+        self._line_time = line_time
+        self._start_time = start_time
+        self.duration = num_lines * line_time
+
+        self._lines_done = 0
+
+    def is_finished(self) -> bool:
+        return self._lines_done == self._num_lines
+
+    def advance(self, now: float) -> list[tuple[str, float]]:
+        """
+        advance scan to the specified time
+
+        returns (motor name, position) for the motors, at the end of
+        the last completed line, if any new lines have been completed
+        """
+        if now >= self._start_time + self.duration:
+            lines_done = self._num_lines
+        else:
+            lines_done = int((now - self._start_time) / self._line_time)
+
+        if lines_done <= self._lines_done:
+            return []
+
+        self._lines_done = lines_done
+        positions = self._positions[:, lines_done - 1, -1]
+
+        return list(zip(self.motors, positions.tolist()))
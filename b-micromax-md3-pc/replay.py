@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Replay captured exporter sessions against a live MD3 exporter emulator.
+
+Reads a capture log written by exporter in capture mode (see capture.py),
+and re-opens all the captured client connections, sending the inbound frames
+with the same timing as they were recorded, optionally sped up.
+
+The replies are matched to the requests in order, and their timing is compared
+to the captured timing. The divergence of each reply is the difference between
+the time it was received, relative to the replay start, and the time it was
+sent in the capture, relative to the capture start and scaled by the speed up.
+
+The results are written as a JSON document. The exit code is 1 if
+any reply diverges more than the given tolerance, is missing, or is received
+without a request waiting for it.
+"""
+import sys
+import json
+import time
+import asyncio
+from collections import deque
+from argparse import ArgumentParser
+from capture import Entry, Direction, read_capture
+from exporter_bench import STX, ETX, latency_summary
+
+# max seconds to wait for outstanding replies, before closing a connection
+REPLY_TIMEOUT = 5.0
+
+
+def parse_args():
+    parser = ArgumentParser(description="Replay captured MD3 exporter sessions")
+
+    parser.add_argument("capture", help="capture log file")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("-p", "--port", type=int, default=9001)
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed up factor, e.g. 2 replays twice as fast as captured",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=10.0,
+        help="max allowed reply timing divergence, in milliseconds",
+    )
+    parser.add_argument("-o", "--output", help="write results to file")
+
+    return parser.parse_args()
+
+
+def _is_event(frame: bytes) -> bool:
+    return frame.startswith(STX + b"EVT:")
+
+
+async def _sleep_until(deadline: float):
+    await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+
+
+class _Session:
+    """
+    replays one captured client connection
+    """
+
+    def __init__(self, entries: list[Entry], capture_start: float, speed: float):
+        self._entries = entries
+        self._capture_start = capture_start
+        self._speed = speed
+
+        # captured replies, in the order of requests
+        self._captured_replies = deque(
+            e for e in entries if e.direction == Direction.OUT and not _is_event(e.data)
+        )
+        # (send time, request entry, captured reply entry) of requests waiting for reply
+        self._pending = deque()
+        self._replied = asyncio.Event()
+
+        self.send_lags = []
+        self.divergences = []
+        self.captured_latencies = []
+        self.replayed_latencies = []
+        self.mismatched_replies = 0
+        self.missing_replies = 0
+        # replies received when no request was waiting for one
+        self.unexpected_replies = 0
+        self.captured_events = sum(
+            1 for e in entries if e.direction == Direction.OUT and _is_event(e.data)
+        )
+        self.received_events = 0
+
+    def _scheduled(self, entry: Entry, replay_start: float) -> float:
+        return replay_start + (entry.timestamp - self._capture_start) / self._speed
+
+    async def _receive(self, reader: asyncio.StreamReader, replay_start: float):
+        buffer = b""
+        while (data := await reader.read(64 * 1024)) != b"":
+            now = time.monotonic()
+            buffer += data
+            end = buffer.rfind(ETX)
+            if end == -1:
+                continue
+
+            frames = [f + ETX for f in buffer[: end + 1].split(ETX)[:-1]]
+            buffer = buffer[end + 1 :]
+
+            for frame in frames:
+                if _is_event(frame):
+                    self.received_events += 1
+                    continue
+
+                if not self._pending:
+                    self.unexpected_replies += 1
+                    continue
+
+                sent, in_entry, reply = self._pending.popleft()
+                self.replayed_latencies.append(now - sent)
+                if reply is None:
+                    # more requests than replies in the capture
+                    continue
+
+                self.captured_latencies.append(reply.timestamp - in_entry.timestamp)
+                self.divergences.append(now - self._scheduled(reply, replay_start))
+                if frame != reply.data:
+                    self.mismatched_replies += 1
+
+            self._replied.set()
+
+    async def _wait_replies(self):
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while self._pending and time.monotonic() < deadline:
+            self._replied.clear()
+            try:
+                await asyncio.wait_for(
+                    self._replied.wait(), deadline - time.monotonic()
+                )
+            except asyncio.TimeoutError:
+                break
+
+        self.missing_replies += len(self._pending)
+
+    async def run(self, host: str, port: int, replay_start: float):
+        # connect at the same time as the captured client did
+        await _sleep_until(self._scheduled(self._entries[0], replay_start))
+        reader, writer = await asyncio.open_connection(host, port)
+        receiver = asyncio.create_task(self._receive(reader, replay_start))
+
+        for entry in self._entries:
+            if entry.direction != Direction.IN:
+                continue
+
+            await _sleep_until(self._scheduled(entry, replay_start))
+
+            now = time.monotonic()
+            self.send_lags.append(now - self._scheduled(entry, replay_start))
+            reply = self._captured_replies.popleft() if self._captured_replies else None
+            self._pending.append((now, entry, reply))
+            writer.write(entry.data)
+
+        await self._wait_replies()
+
+        # keep the connection open for as long as it was in the capture
+        await _sleep_until(self._scheduled(self._entries[-1], replay_start))
+
+        receiver.cancel()
+        writer.close()
+
+
+def _load_sessions(path: str, speed: float) -> tuple[list, float]:
+    _, entries = read_capture(path)
+
+    by_connection: dict[int, list[Entry]] = {}
+    for entry in entries:
+        by_connection.setdefault(entry.connection_id, []).append(entry)
+
+    if not by_connection:
+        return [], 0.0
+
+    capture_start = min(e[0].timestamp for e in by_connection.values())
+    capture_end = max(e[-1].timestamp for e in by_connection.values())
+    sessions = [_Session(e, capture_start, speed) for e in by_connection.values()]
+
+    return sessions, capture_end - capture_start
+
+
+async def _replay(args) -> dict:
+    sessions, captured_duration = _load_sessions(args.capture, args.speed)
+
+    # give the sessions a moment to get started, before the first frame is due
+    replay_start = time.monotonic() + 0.1
+    await asyncio.gather(
+        *[session.run(args.host, args.port, replay_start) for session in sessions]
+    )
+    replay_duration = time.monotonic() - replay_start
+
+    def collect(attr):
+        return [val for s in sessions for val in getattr(s, attr)]
+
+    divergences = collect("divergences")
+    tolerance = args.tolerance / 1000.0
+
+    return dict(
+        config=dict(
+            capture=args.capture,
+            host=args.host,
+            port=args.port,
+            speed=args.speed,
+            tolerance_ms=args.tolerance,
+        ),
+        sessions=len(sessions),
+        captured_duration=captured_duration,
+        expected_duration=captured_duration / args.speed,
+        replay_duration=replay_duration,
+        requests=sum(len(s.replayed_latencies) for s in sessions),
+        missing_replies=sum(s.missing_replies for s in sessions),
+        mismatched_replies=sum(s.mismatched_replies for s in sessions),
+        unexpected_replies=sum(s.unexpected_replies for s in sessions),
+        captured_events=sum(s.captured_events for s in sessions),
+        received_events=sum(s.received_events for s in sessions),
+        send_lag_ms=latency_summary(collect("send_lags")),
+        captured_latency_ms=latency_summary(collect("captured_latencies")),
+        replayed_latency_ms=latency_summary(collect("replayed_latencies")),
+        divergence_ms=latency_summary(divergences),
+        diverged_replies=sum(1 for d in divergences if abs(d) > tolerance),
+    )
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(_replay(args))
+
+    text = json.dumps(results, indent=2)
+    if args.output is None:
+        sys.stdout.write(f"{text}\n")
+    else:
+        with open(args.output, "w") as out:
+            out.write(f"{text}\n")
+
+    failures = ("diverged_replies", "missing_replies", "unexpected_replies")
+    if any(results[name] > 0 for name in failures):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+MD3Up tasks book-keeping
+
+Tasks are identified by their synchronization ID. Running tasks are kept in
+a heap, ordered by their end time. Finished tasks are kept in a bounded ring,
+so that the clients can query them for a while after they are done.
+"""
+import heapq
+from collections import deque
+from datetime import datetime
+from dataclasses import dataclass
+from typing import Optional
+
+# number of finished tasks to remember
+MAX_FINISHED_TASKS = 256
+
+# task flags, as reported by getTaskInfo
+TASK_FLAGS = "8"
+
+
+def epoch_as_text(epoch: float) -> str:
+    """
+    convert time in epoch seconds to textual date-time format
+    """
+    txt = datetime.fromtimestamp(epoch).strftime("%Y-%m-%d %H:%M:%S.%f")
+    # cut of last 3 digit, so that seconds are returned with milliseconds precision,
+    # e.g '2023-12-12 15:44:15.695130' becomes '2023-12-12 15:44:15.695'
+    return txt[:-3]
+
+
+@dataclass
+class Task:
+    task_id: int
+    name: str
+    # times are in unix epoch seconds
+    start_time: float
+    end_time: float
+    finished: bool = False
+    aborted: bool = False
+
+    def info(self) -> list[str]:
+        """
+        task description, in the format used by getTaskInfo command
+        and LastTaskInfo attribute
+        """
+        if not self.finished:
+            return [self.name, TASK_FLAGS, epoch_as_text(self.start_time)] + [""] * 4
+
+        if self.aborted:
+            result, exception = "false", "Task aborted"
+        else:
+            result, exception = "true", "null"
+
+        return [
+            self.name,
+            TASK_FLAGS,
+            epoch_as_text(self.start_time),
+            epoch_as_text(self.end_time),
+            result,
+            exception,
+            "1",
+        ]
+
+
+class TaskRegistry:
+    def __init__(self, max_finished: int = MAX_FINISHED_TASKS):
+        self._synchronization_id = 0
+
+        # heap of (end time, task ID) tuples
+        self._running: list[tuple[float, int]] = []
+        # IDs of finished tasks, oldest first
+        self._finished = deque()
+        self._max_finished = max_finished
+
+        # all running and remembered finished tasks, by ID
+        self._tasks: dict[int, Task] = {}
+
+    def add(self, name: str, running_time: float, now: float) -> Task:
+        self._synchronization_id += 1
+        task = Task(self._synchronization_id, name, now, now + running_time)
+
+        self._tasks[task.task_id] = task
+        heapq.heappush(self._running, (task.end_time, task.task_id))
+
+        return task
+
+    def get(self, task_id: int) -> Optional[Task]:
+        return self._tasks.get(task_id)
+
+    def has_running(self) -> bool:
+        return len(self._running) > 0
+
+    def _finish(self, task: Task):
+        task.finished = True
+
+        self._finished.append(task.task_id)
+        if len(self._finished) > self._max_finished:
+            del self._tasks[self._finished.popleft()]
+
+    def expire(self, now: float) -> list[Task]:
+        """
+        mark all tasks that have reached their end time as finished
+
+        returns newly finished tasks, in the order they have finished
+        """
+        finished = []
+
+        while self._running and self._running[0][0] <= now:
+            _, task_id = heapq.heappop(self._running)
+            task = self._tasks[task_id]
+            self._finish(task)
+            finished.append(task)
+
+        return finished
+
+    def abort(self, now: float) -> list[Task]:
+        """
+        end all currently running tasks
+
+        returns the aborted tasks
+        """
+        aborted = []
+
+        for _, task_id in sorted(self._running):
+            task = self._tasks[task_id]
+            task.end_time = now
+            task.aborted = True
+            self._finish(task)
+            aborted.append(task)
+
+        self._running.clear()
+
+        return aborted
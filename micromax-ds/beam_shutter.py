@@ -1,8 +1,8 @@
 #!/usr/bin/env python
-import time
 from enum import Enum
 from tango import DevState
 from tango.server import Device, attribute, command
+from emuclock import clock
 
 
 class Position(Enum):
@@ -21,14 +21,14 @@ class Shutter:
     def _move_to_position(self, position):
         self._current_position = None
         self._destination_position = position
-        self._arrival_time = time.monotonic() + self.TRAVEL_TIME
+        self._arrival_time = clock.monotonic() + self.TRAVEL_TIME
 
     def _update_position(self):
         if self._destination_position is None:
             # not moving, nothing to update
             return
 
-        if time.monotonic() < self._arrival_time:
+        if clock.monotonic() < self._arrival_time:
             # still moving, nothing to update
             return
 
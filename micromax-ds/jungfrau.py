@@ -1,11 +1,11 @@
 #!/usr/bin/env python
-import time
 from enum import Enum
 from typing import Optional, Union, Any
 from dataclasses import dataclass
 from threading import Thread
 from tango import AttrWriteType, DevState
 from tango.server import Device, attribute, command
+from emuclock import clock
 
 
 ARM_DELAY = 1.2
@@ -60,7 +60,7 @@ DETECTOR_TO_TANGO_STATE = {
 
 def delayed(delay, delayed_call):
     def run():
-        time.sleep(delay)
+        clock.sleep(delay)
         delayed_call()
 
     Thread(target=run).start()
@@ -114,7 +114,7 @@ class Jungfrau(Device):
     @command
     def Arm(self):
         # emulate that it take a second or so to arm the detector
-        time.sleep(ARM_DELAY)
+        clock.sleep(ARM_DELAY)
         self._state = _DetectorState.MEASURING
 
     @command
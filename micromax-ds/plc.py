@@ -1,8 +1,7 @@
 #!/usr/bin/env python
-import time
-
 from tango import AttrWriteType
 from tango.server import Device, attribute
+from emuclock import clock
 
 ATTRIBUTES = [
     # Eiger detector cover tags
@@ -24,7 +23,7 @@ class _DetectorCover:
         self._toggle_state_at = None
 
     def _toggle_state(self):
-        self._toggle_state_at = time.monotonic() + self.TRAVEL_TIME
+        self._toggle_state_at = clock.monotonic() + self.TRAVEL_TIME
 
     def is_open(self):
         def update_state():
@@ -32,7 +31,7 @@ class _DetectorCover:
                 # no update pending
                 return
 
-            if time.monotonic() < self._toggle_state_at:
+            if clock.monotonic() < self._toggle_state_at:
                 # too early to update the state
                 return
 